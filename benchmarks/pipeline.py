@@ -0,0 +1,219 @@
+import argparse
+import json
+import logging
+import platform
+import resource
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy as np
+import os
+import tensorflow as tf
+
+from datasets import Hierarchy
+from datasets.cache import PREPROCESS_VERSION
+from datasets.cifar100 import _parse_cifar100, load_cifar100
+from datasets.pipeline import build_dataset
+from datasets.preprocess import (load_preprocessed_data, per_img_preprocess,
+                                 preprocess_dataset_and_save, shuffle_data)
+from datasets.whitening import ZCATransform
+
+logger = logging.getLogger('benchmark-pipeline')
+
+ARRAYS = ['x', 'y', 'y_c', 'x_test', 'y_test', 'y_test_c']
+
+
+class PeakMemory:
+    def __init__(self, interval=.005):
+        """
+        Samples the resident memory of the process in a background thread
+        while a stage runs, and keeps the peak above the resident memory at
+        the start of the stage
+        """
+        self.interval = interval
+        self.baseline = 0
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.baseline = self.peak = _rss()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, _rss())
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, _rss())
+
+    @property
+    def increase(self):
+        return self.peak - self.baseline
+
+
+def _rss():
+    # Current resident set size in bytes, read from /proc on Linux and
+    # approximated by the peak so far elsewhere
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run_stage(results, name, n_images, fn):
+    with PeakMemory() as memory:
+        time1 = time.time()
+        output = fn()
+        seconds = time.time() - time1
+    results[name] = {
+        'seconds': seconds,
+        'images': n_images,
+        'images_per_second': n_images / seconds if seconds > 0 else None,
+        'peak_memory_mb': memory.peak / 2 ** 20,
+        'memory_increase_mb': memory.increase / 2 ** 20,
+    }
+    logger.info(f"{name}: {seconds:.2f}s, "
+                f"{results[name]['images_per_second'] or 0:.0f} images/s, "
+                f"peak {results[name]['peak_memory_mb']:.0f} MB "
+                f"(+{results[name]['memory_increase_mb']:.0f} MB)")
+    return output
+
+
+def get_data(args, results, scratch):
+    if args.synthetic:
+        rng = np.random.RandomState(0)
+        n = args.synthetic + args.n_test
+
+        def generate():
+            x = rng.randint(0, 256, (n, 32, 32, 3)).astype(np.uint8)
+            y = rng.randint(0, 100, (n, 1))
+            return x, y, y // 5
+
+        x, y, y_c = run_stage(results, 'generate', n, generate)
+        split = args.synthetic
+        return ((x[:split], y[:split], y_c[:split]),
+                (x[split:], y[split:], y_c[split:]))
+
+    # Parsing the archive into the layout load_cifar100 reads under the
+    # scratch directory times a cold start, and loading it back never touches
+    # the parsed cache of the data directory
+    run_stage(results, 'parse_archive', 60000,
+              lambda: _parse_cifar100(args.data_dir,
+                                      os.path.join(scratch, 'datasets',
+                                                   'cifar-100-npy')))
+    (x, y, y_c), (x_test, y_test, y_test_c) = run_stage(
+        results, 'load_cifar100', 60000,
+        lambda: load_cifar100(scratch))
+    return (x, y, y_c), (x_test[:args.n_test], y_test[:args.n_test],
+                         y_test_c[:args.n_test])
+
+
+def main(args):
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    results = {}
+    scratch = tempfile.mkdtemp(prefix='benchmark-pipeline-')
+    try:
+        (x, y, y_c), (x_test, y_test, y_test_c) = get_data(args, results,
+                                                            scratch)
+        n, n_test = len(x), len(x_test)
+        logger.info(f'Benchmarking on {n} training and {n_test} test images')
+
+        run_stage(results, 'hierarchy', n, lambda: Hierarchy.from_labels(y, y_c))
+        transform = run_stage(
+            results, 'zca_fit', n,
+            lambda: ZCATransform.fit(x, n_components=args.zca_components))
+        x_white = run_stage(results, 'zca_apply', n + n_test,
+                            lambda: (transform(x), transform(x_test)))[0]
+        x_aug, y_aug = run_stage(
+            results, 'per_img_preprocess', n,
+            lambda: per_img_preprocess(x_white, y.reshape(-1)))
+        del x_aug, y_aug
+
+        # The whole preprocessing as the training scripts run it, then the
+        # cache read back eagerly and memory-mapped
+        cache_dir = os.path.join(scratch, 'cache')
+        run_stage(results, 'preprocess_and_save', n,
+                  lambda: preprocess_dataset_and_save(
+                      np.array(x), y, y_c, np.array(x_test), y_test, y_test_c,
+                      cache_dir, whitening=True,
+                      zca_components=args.zca_components))
+        data = run_stage(results, 'load', 2 * n + n_test,
+                         lambda: load_preprocessed_data(cache_dir))
+        run_stage(results, 'save', 2 * n + n_test,
+                  lambda: [np.save(os.path.join(scratch, 'copy_' + name),
+                                   np.asarray(a))
+                           for name, a in zip(ARRAYS, data)])
+        mapped = run_stage(results, 'load_mmap', 2 * n + n_test,
+                           lambda: load_preprocessed_data(cache_dir, mmap=True))
+        x_cache, y_cache = data[0], data[1]
+        run_stage(results, 'shuffle_data', len(x_cache),
+                  lambda: shuffle_data((x_cache, y_cache)))
+        del data
+
+        def epoch():
+            dataset = build_dataset(mapped[0], mapped[1], args.batch_size,
+                                    shuffle=True)
+            for _ in dataset:
+                pass
+
+        run_stage(results, 'pipeline_epoch_mmap', len(mapped[0]), epoch)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    report = {
+        'config': {
+            'source': 'synthetic' if args.synthetic else 'cifar100',
+            'n_train': n,
+            'n_test': n_test,
+            'zca_components': args.zca_components,
+            'batch_size': args.batch_size,
+            'preprocess_version': PREPROCESS_VERSION,
+            'tensorflow': tf.__version__,
+            'numpy': np.__version__,
+            'python': platform.python_version(),
+            'cpu_count': os.cpu_count(),
+        },
+        'stages': results,
+    }
+    if args.results:
+        json.dump(report, open(args.results, 'w'), indent=2)
+    return report
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Time, throughput and peak memory of every stage of the '
+                    'data path, from the archive to a pipeline epoch'
+    )
+    parser.add_argument('--data_dir', help='Where the CIFAR-100 archive is stored'
+                                           ' (defaults to ./data)',
+                        type=str, default='./data')
+    parser.add_argument('--synthetic', help='Use this many random training images '
+                                            'instead of CIFAR-100',
+                        type=int, default=0)
+    parser.add_argument('--n_test', help='Number of test images',
+                        type=int, default=10000)
+    parser.add_argument('--zca_components', help='Keep only the top K principal components '
+                                                 'in the ZCA whitening (defaults to all)',
+                        type=int, default=None)
+    parser.add_argument('-b', '--batch_size', help='Batch size of the pipeline epoch',
+                        type=int, default=64)
+    parser.add_argument('-r', '--results', help='Results file',
+                        type=str, default='')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    main(args)
@@ -0,0 +1,113 @@
+import argparse
+import json
+import logging
+import time
+
+import numpy as np
+
+from datasets.cifar100 import load_data
+from datasets.whitening import ZCATransform
+
+logger = logging.getLogger('benchmark-zca')
+
+
+def get_images(args):
+    if args.synthetic:
+        rng = np.random.RandomState(0)
+        x = rng.randint(0, 256, (args.synthetic, 32, 32, 3)).astype(np.uint8)
+        y = rng.randint(0, 100, args.synthetic)
+        return (x[:-args.n_test], y[:-args.n_test]), (x[-args.n_test:],
+                                                      y[-args.n_test:])
+    (x, y), (x_test, y_test) = load_data('fine', args.data_dir)
+    return (x, y.reshape(-1)), (x_test[:args.n_test],
+                                y_test[:args.n_test].reshape(-1))
+
+
+def class_means(x, y):
+    classes = np.unique(y)
+    return classes, np.stack([x[y == c].mean(axis=0) for c in classes])
+
+
+def nearest_mean_accuracy(whitened, y, classes, whitened_means):
+    # The whitening is affine, so the means of the whitened classes are the
+    # whitened class means and the training set is never whitened
+    flat = whitened.reshape(len(whitened), -1)
+    means = whitened_means.reshape(len(whitened_means), -1)
+    distances = ((flat ** 2).sum(axis=1)[:, None] - 2 * flat.dot(means.T) +
+                 (means ** 2).sum(axis=1)[None, :])
+    return float(np.mean(classes[distances.argmin(axis=1)] == y))
+
+
+def benchmark(transform_fn, x, x_test, y_test, means, reference=None):
+    time1 = time.time()
+    transform = transform_fn(x)
+    time2 = time.time()
+    whitened = transform(x_test)
+    time3 = time.time()
+    result = {
+        'fit_seconds': time2 - time1,
+        'apply_images_per_second': len(x_test) / (time3 - time2),
+        'retained_variance': transform.retained_variance,
+        'nearest_mean_accuracy': nearest_mean_accuracy(
+            whitened, y_test, means[0], transform(means[1])),
+    }
+    if reference is not None:
+        result['relative_error'] = float(
+            np.linalg.norm(whitened - reference) / np.linalg.norm(reference))
+    return result, whitened
+
+
+def main(args):
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    (x, y), (x_test, y_test) = get_images(args)
+    logger.info(f'Fitting on {len(x)} images, applying to {len(x_test)}')
+    means = class_means(x, y)
+
+    # Below D images the covariance is singular, and the full transform
+    # scales its null directions by 1 / sqrt(epsilon). The full versus
+    # low-rank comparison then mostly measures that artifact
+    d = int(np.prod(x.shape[1:]))
+    results = {'fit_images': len(x), 'dimensions': d,
+               'rank_deficient': len(x) < d}
+    if len(x) < d:
+        logger.warning(f'Fitting on {len(x)} images in {d} dimensions: the '
+                       f'covariance is rank deficient, use at least {d} '
+                       f'images to compare the transforms')
+    results['full'], reference = benchmark(ZCATransform.fit, x, x_test,
+                                           y_test, means)
+    logger.info(f"full: {results['full']}")
+    for k in args.components:
+        results[f'top_{k}'], _ = benchmark(
+            lambda images: ZCATransform.fit(images, n_components=k),
+            x, x_test, y_test, means, reference)
+        logger.info(f"top_{k}: {results[f'top_{k}']}")
+
+    if args.results:
+        json.dump(results, open(args.results, 'w'), indent=2)
+    return results
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Full versus low-rank ZCA whitening benchmark'
+    )
+    parser.add_argument('--data_dir', help='Where the CIFAR-100 archive is stored'
+                                           ' (defaults to ./data)',
+                        type=str, default='./data')
+    parser.add_argument('--synthetic', help='Use this many random images instead of CIFAR-100 '
+                                            '(at least n_test + 3072 for a full-rank fit)',
+                        type=int, default=0)
+    parser.add_argument('--n_test', help='Number of images whitened to time the transform',
+                        type=int, default=5000)
+    parser.add_argument('-k', '--components', help='Numbers of components of the low-rank fits',
+                        type=int, nargs='+', default=[64, 256, 1024])
+    parser.add_argument('-r', '--results', help='Results file',
+                        type=str, default='')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    main(args)
@@ -1 +1,3 @@
-from .cifar100 import get_cifar100
+from .cifar100 import get_cifar100, get_cifar100_split, get_cifar100_whitening
+from .cifar100 import attach_cifar100, host_cifar100, preprocess_cifar100
+from .hierarchy import Hierarchy
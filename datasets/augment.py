@@ -0,0 +1,102 @@
+import logging
+
+import tensorflow as tf
+
+logger = logging.getLogger('augment')
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+# Per image transform probabilities used when augmenting online. Every epoch
+# sees each image flipped, rotated and cropped with the same odds the static
+# augmented copy mixes them with
+ONLINE_AUGMENTATION = {
+    'flip_left_right': .5,
+    'flip_up_down': .5,
+    'rot90': .5
+}
+
+# Number of images augmented per batch when building the static augmented
+# copy. Every batch draws its transforms from its own seed [seed, batch index],
+# so a builder working on chunks aligned to it writes the same images
+AUGMENT_BATCH_SIZE = 1024
+
+
+################################################################################
+#    Title: Augment batch
+################################################################################
+#    Description:
+#        This function pads a batch of images, randomly crops them back to
+#        their original size and randomly flips and rotates them. Every random
+#        transform is folded into a single index grid so the whole batch is
+#        produced by one gather instead of one op per image
+#
+#    Parameters:
+#        images             Batch of BxHxWxC images (H == W when rot90 > 0)
+#        seed               Shape [2] seed of the stateless random draws
+#        pad                Number of pixels padded on each side before
+#                           cropping
+#        flip_left_right    Probability of flipping an image horizontally
+#        flip_up_down       Probability of flipping an image vertically
+#        rot90              Probability of rotating an image by 90 degrees
+#
+#    Returns:
+#        A batch of BxHxWxC augmented images
+################################################################################
+def augment_batch(images, seed, pad=4, flip_left_right=0.5, flip_up_down=0.,
+                  rot90=0.):
+    with tf.name_scope('Augment'):
+        images = tf.convert_to_tensor(images)
+        h, w = images.shape[1], images.shape[2]
+        n = tf.shape(images)[0]
+
+        padded = tf.pad(images, [[0, 0], [pad, pad], [pad, pad], [0, 0]])
+
+        draws = tf.random.stateless_uniform([n, 5], seed=seed)
+        offsets = tf.cast(draws[:, :2] * (2 * pad + 1), tf.int32)
+        offsets = tf.minimum(offsets, 2 * pad)
+        flip_lr = draws[:, 2] < flip_left_right
+        flip_ud = draws[:, 3] < flip_up_down
+        rotate = draws[:, 4] < rot90
+
+        # The grid maps output pixels to source pixels, so the transforms are
+        # folded in from the last one applied to the image to the first:
+        # flip_up_down(rot90(flip_left_right(image))), the order of the
+        # original per image ops
+        rows = tf.broadcast_to(tf.range(h)[None, :, None], [n, h, w])
+        cols = tf.broadcast_to(tf.range(w)[None, None, :], [n, h, w])
+        rows = tf.where(flip_ud[:, None, None], (h - 1) - rows, rows)
+        if rot90 > 0:
+            rotate = rotate[:, None, None]
+            rows, cols = (tf.where(rotate, cols, rows),
+                          tf.where(rotate, (w - 1) - rows, cols))
+        cols = tf.where(flip_lr[:, None, None], (w - 1) - cols, cols)
+
+        rows += offsets[:, 0, None, None]
+        cols += offsets[:, 1, None, None]
+        indices = tf.stack([rows, cols], axis=-1)
+        return tf.gather_nd(padded, indices, batch_dims=1)
+
+
+################################################################################
+#    Title: Augment images
+################################################################################
+#    Description:
+#        This function runs augment_batch over a whole image set in batches,
+#        spreading the batches over the available cores
+#
+#    Parameters:
+#        x             Array of MxHxWxC images
+#        batch_size    Number of images augmented per batch
+#        seed          Seed of the augmentation
+#        kwargs        Transform probabilities passed to augment_batch
+#
+#    Returns:
+#        An array of MxHxWxC augmented images
+################################################################################
+def augment_images(x, batch_size=AUGMENT_BATCH_SIZE, seed=0, **kwargs):
+    dataset = tf.data.Dataset.from_tensor_slices(x).batch(batch_size)
+    dataset = dataset.enumerate().map(
+        lambda i, batch: augment_batch(
+            batch, tf.stack([tf.constant(seed, tf.int64), i]), **kwargs),
+        num_parallel_calls=AUTOTUNE)
+    return tf.concat(list(dataset.prefetch(AUTOTUNE)), 0)
@@ -0,0 +1,79 @@
+import hashlib
+import json
+import logging
+from datetime import datetime
+
+import numpy as np
+import os
+
+logger = logging.getLogger('cache')
+
+# Bump whenever a change to the preprocessing code changes the arrays it
+# writes, so caches built by older code stop matching
+PREPROCESS_VERSION = 6
+
+MANIFEST = 'manifest.json'
+
+
+def fingerprint(params, source_hash):
+    """Hash of everything the preprocessed arrays depend on: the
+    preprocessing parameters, the source archive and the code version.
+    """
+    key = json.dumps({'params': params,
+                      'source_hash': source_hash,
+                      'version': PREPROCESS_VERSION}, sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+def cache_directory(data_directory, params, source_hash):
+    """Directory of the cache variant matching `params` and `source_hash`.
+    Every variant lives side by side under `preprocessed_data`.
+    """
+    return os.path.join(data_directory, 'preprocessed_data',
+                        fingerprint(params, source_hash))
+
+
+def read_manifest(cache_dir):
+    """Returns the manifest of a cache variant, or None when the variant does
+    not exist or was not completely written.
+    """
+    path = os.path.join(cache_dir, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(cache_dir, params, source_hash):
+    """Records how a cache variant was built along with the shape and dtype of
+    its arrays. The manifest is written last and marks the variant complete.
+    """
+    arrays = {}
+    for name in sorted(os.listdir(cache_dir)):
+        if name.endswith('.npy'):
+            a = np.load(os.path.join(cache_dir, name), mmap_mode='r')
+            arrays[name[:-4]] = {'shape': list(a.shape), 'dtype': str(a.dtype)}
+    manifest = {'fingerprint': fingerprint(params, source_hash),
+                'params': params,
+                'source_hash': source_hash,
+                'version': PREPROCESS_VERSION,
+                'created': datetime.now().strftime("%Y%m%d-%H%M%S"),
+                'arrays': arrays}
+    tmp = os.path.join(cache_dir, MANIFEST + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, os.path.join(cache_dir, MANIFEST))
+    return manifest
+
+
+def list_variants(data_directory):
+    """Manifests of every complete cache variant under `data_directory`."""
+    root = os.path.join(data_directory, 'preprocessed_data')
+    if not os.path.isdir(root):
+        return []
+    manifests = []
+    for name in sorted(os.listdir(root)):
+        manifest = read_manifest(os.path.join(root, name))
+        if manifest is not None:
+            manifests.append(manifest)
+    return manifests
@@ -1,41 +1,201 @@
+import functools
 import logging
+import pickle
+import shutil
+import tempfile
 
 import numpy as np
 import os
 import tensorflow as tf
 from tensorflow.python.keras import backend as K
-from tensorflow.python.keras.datasets.cifar import load_batch
 from tensorflow.python.keras.utils.data_utils import get_file
 
-from .preprocess import load_preprocessed_data, build_fine2coarse_matrix
-from .preprocess import preprocess_dataset_and_save
+from . import cache
+from .hierarchy import Hierarchy
+from .parallel import preprocess_parallel
+from .preprocess import load_preprocessed_data, split_indices, subset_indices
+from .preprocess import preprocess_dataset, preprocess_dataset_and_save
+from .shared import SharedArrays
+from .whitening import ZCATransform
 
 logger = logging.getLogger('CIFAR-100')
 
+CIFAR100_HASH = '85cd44d02ba6437773c5bbd22e183051d648de2e7d6b014e1ef29b855ba677a7'
 
-def get_cifar100(data_directory):
-    (x, y_c), (x_test, y_test_c) = load_data('coarse', data_directory)
-    (x, y), (x_test, y_test) = load_data('fine', data_directory)
-    fine2coarse = build_fine2coarse_matrix(y_test, y_test_c)
-    n_fine = len(np.unique(y_test))
-    n_coarse = len(np.unique(y_test_c))
-    if 'preprocessed_data' not in os.listdir(data_directory):
-        logger.info("Preprocessing data")
+# Parsed arrays of the archive, saved next to it after the first load
+PARSED_ARRAYS = ('x_train', 'y_train', 'y_train_c', 'x_test', 'y_test', 'y_test_c')
+
+
+def get_cifar100(data_directory, augmentation='static', mmap=False,
+                 zca_components=None, storage='float32', subset=None):
+    if subset is not None:
+        return get_cifar100_subset(data_directory, subset, augmentation,
+                                   zca_components)
+    if storage == 'uint8' and augmentation != 'online':
+        raise ValueError('uint8 storage requires online augmentation')
+    (x, y, y_c), (x_test, y_test, y_test_c) = load_cifar100(data_directory,
+                                                            mmap=True)
+    fine2coarse = Hierarchy.from_labels(y_test, y_test_c)
+    n_fine = fine2coarse.n_fine
+    n_coarse = fine2coarse.n_coarse
+    params = _preprocessing_params(augmentation, zca_components, storage)
+    cache_dir = cache.cache_directory(data_directory, params, CIFAR100_HASH)
+    if cache.read_manifest(cache_dir) is None:
+        logger.info(f"Preprocessing data into {cache_dir}")
+        # Read the raw images, they are only mapped until needed
+        x, x_test = np.array(x), np.array(x_test)
         x, y, y_c, x_test, y_test, y_test_c = preprocess_dataset_and_save(
-            x, y, y_c, x_test, y_test, y_test_c, data_directory, whitening=True)
+            x, y, y_c, x_test, y_test, y_test_c, cache_dir,
+            whitening=params['whitening'], augmentation=augmentation,
+            seed=params['seed'], zca_components=zca_components,
+            storage=storage)
+        cache.write_manifest(cache_dir, params, CIFAR100_HASH)
+        if mmap:
+            del x, x_test
+            x, y, y_c, x_test, y_test, y_test_c = load_preprocessed_data(
+                cache_dir, mmap=True)
     else:
+        logger.info(f"Loading preprocessed data from {cache_dir}")
         x, y, y_c, x_test, y_test, y_test_c = load_preprocessed_data(
-            data_directory)
+            cache_dir, mmap)
+
+    if storage == 'uint8':
+        # Training images stay uint8 and are whitened per batch by the input
+        # pipeline, the test set is whitened once
+        logger.info("Whitening test data")
+        x_test = ZCATransform.load(cache_dir)(x_test)
+        return (x, y), (x_test, y_test), fine2coarse, n_fine, n_coarse
+
+    if mmap:
+        return (x, y), (x_test, y_test), fine2coarse, n_fine, n_coarse
 
     logger.info("Casting data into float32")
     x = tf.cast(x, tf.float32)
-    y = tf.cast(y, tf.float32)
     x_test = tf.cast(x_test, tf.float32)
-    y_test = tf.cast(y_test, tf.float32)
 
     return (x, y), (x_test, y_test), fine2coarse, n_fine, n_coarse
 
 
+def preprocess_cifar100(data_directory, augmentation='static', zca_components=None,
+                        storage='float32', workers=None, chunk_size=5120):
+    """Builds the cache variant get_cifar100 loads with a pool of worker
+    processes, resuming an interrupted run. Does nothing when the variant is
+    already complete.
+    """
+    if storage == 'uint8' and augmentation != 'online':
+        raise ValueError('uint8 storage requires online augmentation')
+    params = _preprocessing_params(augmentation, zca_components, storage)
+    cache_dir = cache.cache_directory(data_directory, params, CIFAR100_HASH)
+    if cache.read_manifest(cache_dir) is not None:
+        logger.info(f"{cache_dir} is already preprocessed")
+        return cache_dir
+    # Parse the archive once before the workers map the parsed arrays
+    load_cifar100(data_directory, mmap=True)
+    source = functools.partial(load_cifar100, data_directory, mmap=True)
+    logger.info(f"Preprocessing data into {cache_dir}")
+    preprocess_parallel(source, cache_dir, whitening=params['whitening'],
+                        augmentation=augmentation, seed=params['seed'],
+                        zca_components=zca_components, storage=storage,
+                        workers=workers, chunk_size=chunk_size)
+    cache.write_manifest(cache_dir, params, CIFAR100_HASH)
+    return cache_dir
+
+
+def get_cifar100_subset(data_directory, per_class, augmentation='static',
+                        zca_components=None):
+    """Same as get_cifar100 on only the first `per_class` training and test
+    samples of every fine class. Only those images are read, the whitening is
+    fitted on them and nothing is cached, for fast debug runs.
+    """
+    (x, y, y_c), (x_test, y_test, y_test_c) = load_cifar100(data_directory,
+                                                            mmap=True)
+    fine2coarse = Hierarchy.from_labels(y_test, y_test_c)
+    inds = subset_indices(y, per_class)
+    inds_test = subset_indices(y_test, per_class)
+    logger.info(f"Preprocessing {per_class} samples per class, not cached")
+    if len(inds) < np.prod(x.shape[1:]):
+        # Fine for smoke tests, but the whitened images are not comparable
+        # to the ones of a full run
+        logger.warning(f"Fitting the whitening on {len(inds)} images in "
+                       f"{np.prod(x.shape[1:])} dimensions, the covariance "
+                       f"is rank deficient")
+    x, y, x_test, y_test, _ = preprocess_dataset(
+        x[inds], y[inds], x_test[inds_test], y_test[inds_test],
+        whitening=True, augmentation=augmentation,
+        zca_components=zca_components)
+
+    x = tf.cast(x, tf.float32)
+    x_test = tf.cast(x_test, tf.float32)
+    return ((x, y), (x_test, y_test), fine2coarse, fine2coarse.n_fine,
+            fine2coarse.n_coarse)
+
+
+def host_cifar100(data_directory, augmentation='static', zca_components=None,
+                  storage='float32'):
+    """Places the arrays returned by get_cifar100 in a shared memory segment
+    that other processes attach to with attach_cifar100. The caller owns the
+    segment and releases it with close().
+    """
+    (x, y), (x_test, y_test), _, _, _ = get_cifar100(
+        data_directory, augmentation, mmap=True, zca_components=zca_components,
+        storage=storage)
+    params = _preprocessing_params(augmentation, zca_components, storage)
+    cache_dir = cache.cache_directory(data_directory, params, CIFAR100_HASH)
+    name = 'hcnn-' + os.path.basename(cache_dir)
+    return SharedArrays.host(cache_dir, name, {'x': x, 'y': y,
+                                               'x_test': x_test,
+                                               'y_test': y_test})
+
+
+def attach_cifar100(data_directory, augmentation='static', zca_components=None,
+                    storage='float32'):
+    """Same as get_cifar100, but returns read-only views of the arrays hosted
+    by host_cifar100 instead of loading them. Returns None when they are not
+    hosted.
+    """
+    params = _preprocessing_params(augmentation, zca_components, storage)
+    cache_dir = cache.cache_directory(data_directory, params, CIFAR100_HASH)
+    shared = SharedArrays.attach(cache_dir)
+    if shared is None:
+        return None
+    _, (_, y_test, y_test_c) = load_cifar100(data_directory, mmap=True)
+    fine2coarse = Hierarchy.from_labels(y_test, y_test_c)
+    a = shared.arrays
+    return ((a['x'], a['y']), (a['x_test'], a['y_test']), fine2coarse,
+            fine2coarse.n_fine, fine2coarse.n_coarse)
+
+
+def get_cifar100_whitening(data_directory, augmentation='static',
+                           zca_components=None, storage='float32'):
+    """Returns the ZCA transform fitted when preprocessing the training set,
+    so raw images can be whitened without the training set.
+    """
+    params = _preprocessing_params(augmentation, zca_components, storage)
+    cache_dir = cache.cache_directory(data_directory, params, CIFAR100_HASH)
+    return ZCATransform.load(cache_dir)
+
+
+def get_cifar100_split(data_directory, y, augmentation='static',
+                       zca_components=None, storage='float32', test_size=.1,
+                       random_state=0):
+    """Returns the training and validation indices of the stratified split of
+    the preprocessed training set `y`, persisted with its cache variant.
+    """
+    params = _preprocessing_params(augmentation, zca_components, storage)
+    cache_dir = cache.cache_directory(data_directory, params, CIFAR100_HASH)
+    return split_indices(cache_dir, y, test_size, random_state)
+
+
+def _preprocessing_params(augmentation, zca_components=None,
+                          storage='float32'):
+    params = {'whitening': True, 'augmentation': augmentation, 'seed': 0}
+    if zca_components is not None:
+        params['zca_components'] = zca_components
+    if storage != 'float32':
+        params['storage'] = storage
+    return params
+
+
 def load_data(label_mode='fine', data_directory=None):
     """Loads CIFAR100 dataset. Reference: https://github.com/tensorflow/tensorflow/blob/v2.0.0/tensorflow/python/keras/datasets/cifar100.py
     Arguments:
@@ -48,27 +208,82 @@ def load_data(label_mode='fine', data_directory=None):
     if label_mode not in ['fine', 'coarse']:
         raise ValueError('`label_mode` must be one of `"fine"`, `"coarse"`.')
 
+    (x_train, y_train, y_train_c), (x_test, y_test, y_test_c) = load_cifar100(
+        data_directory)
+    if label_mode == 'coarse':
+        return (x_train, y_train_c), (x_test, y_test_c)
+    return (x_train, y_train), (x_test, y_test)
+
+
+def load_cifar100(data_directory=None, mmap=False):
+    """Loads the CIFAR100 images with both their fine and coarse labels in a
+    single pass over the archive. The parsed arrays are saved as .npy files
+    after the first call, later calls read them without checking or
+    unpickling the archive.
+    Arguments:
+        data_directory: directory holding the `datasets` download cache.
+        mmap: whether to memory-map the images instead of reading them.
+    Returns:
+        Tuple of Numpy arrays:
+        `(x_train, y_train, y_train_c), (x_test, y_test, y_test_c)`.
+    """
+    cache_dir = data_directory or os.path.join(os.path.expanduser('~'), '.keras')
+    parsed_dir = os.path.join(cache_dir, 'datasets', 'cifar-100-npy')
+    if not os.path.isdir(parsed_dir):
+        _parse_cifar100(data_directory, parsed_dir)
+
+    arrays = {}
+    for name in PARSED_ARRAYS:
+        mmap_mode = 'r' if mmap and name.startswith('x') else None
+        arrays[name] = np.load(os.path.join(parsed_dir, name + '.npy'),
+                               mmap_mode=mmap_mode)
+
+    x_train, x_test = arrays['x_train'], arrays['x_test']
+    if K.image_data_format() == 'channels_last':
+        x_train = x_train.transpose(0, 2, 3, 1)
+        x_test = x_test.transpose(0, 2, 3, 1)
+
+    return ((x_train, arrays['y_train'], arrays['y_train_c']),
+            (x_test, arrays['y_test'], arrays['y_test_c']))
+
+
+def _parse_cifar100(data_directory, parsed_dir):
     dirname = 'cifar-100-python'
     origin = 'https://www.cs.toronto.edu/~kriz/cifar-100-python.tar.gz'
     path = get_file(
         dirname,
         origin=origin,
         untar=True,
-        file_hash='85cd44d02ba6437773c5bbd22e183051d648de2e7d6b014e1ef29b8'
-                  '55ba677a7',
+        file_hash=CIFAR100_HASH,
         cache_dir=data_directory)
 
-    fpath = os.path.join(path, 'train')
-    x_train, y_train = load_batch(fpath, label_key=label_mode + '_labels')
-
-    fpath = os.path.join(path, 'test')
-    x_test, y_test = load_batch(fpath, label_key=label_mode + '_labels')
+    logger.info(f"Parsing CIFAR-100 into {parsed_dir}")
+    arrays = {}
+    for split in ['train', 'test']:
+        with open(os.path.join(path, split), 'rb') as f:
+            d = pickle.load(f, encoding='bytes')
+        arrays['x_' + split] = d[b'data'].reshape(-1, 3, 32, 32)
+        arrays['y_' + split] = np.reshape(d[b'fine_labels'], (-1, 1))
+        arrays['y_' + split + '_c'] = np.reshape(d[b'coarse_labels'], (-1, 1))
 
-    y_train = np.reshape(y_train, (len(y_train), 1))
-    y_test = np.reshape(y_test, (len(y_test), 1))
-
-    if K.image_data_format() == 'channels_last':
-        x_train = x_train.transpose(0, 2, 3, 1)
-        x_test = x_test.transpose(0, 2, 3, 1)
-
-    return (x_train, y_train), (x_test, y_test)
+    # Written aside and moved in place, so a parsed directory is complete.
+    # Every process writes its own directory, and a process finding the
+    # parsed directory already moved in place by another one keeps that one
+    parent = os.path.dirname(parsed_dir)
+    os.makedirs(parent, exist_ok=True)
+    tmp = tempfile.mkdtemp(prefix=os.path.basename(parsed_dir) + '.',
+                           suffix='.tmp', dir=parent)
+    try:
+        os.chmod(tmp, 0o755)
+        for name in PARSED_ARRAYS:
+            np.save(os.path.join(tmp, name), arrays[name])
+        if not os.path.isdir(parsed_dir):
+            try:
+                os.replace(tmp, parsed_dir)
+            except OSError:
+                if not os.path.isdir(parsed_dir):
+                    raise
+        if os.path.isdir(tmp):
+            logger.info(f"{parsed_dir} was parsed by another process")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
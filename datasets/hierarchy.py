@@ -0,0 +1,76 @@
+import numpy as np
+import tensorflow as tf
+
+
+class Hierarchy:
+    def __init__(self, index, n_coarse=None):
+        """
+        Two level label hierarchy. `index` holds the coarse class of every fine
+        class; the coarse to fine member lists and the dense and sparse
+        fine2coarse matrices are derived from it when first used
+        """
+        self.index = np.asarray(index, dtype=np.int32)
+        self.n_fine = len(self.index)
+        if n_coarse is None:
+            n_coarse = int(self.index.max()) + 1
+        self.n_coarse = n_coarse
+        self._members = None
+        self._matrix = None
+        self._sparse = None
+
+    @classmethod
+    def from_labels(cls, y, y_c):
+        """Builds the hierarchy from the fine and coarse labels of a set of
+        samples. Every fine class has to appear and belong to a single coarse
+        class.
+        """
+        y = np.asarray(y).reshape(-1)
+        y_c = np.asarray(y_c).reshape(-1)
+        index = np.full(int(y.max()) + 1, -1, dtype=np.int32)
+        index[y] = y_c
+        if np.any(index < 0):
+            raise ValueError('Some fine classes have no samples')
+        if np.any(index[y] != y_c):
+            raise ValueError('Some fine classes belong to several coarse '
+                             'classes')
+        return cls(index, n_coarse=int(y_c.max()) + 1)
+
+    @property
+    def members(self):
+        """Fine classes of every coarse class, as a list of index arrays."""
+        if self._members is None:
+            order = np.argsort(self.index, kind='stable')
+            sizes = np.bincount(self.index, minlength=self.n_coarse)
+            self._members = np.split(order, np.cumsum(sizes)[:-1])
+        return self._members
+
+    @property
+    def matrix(self):
+        """Dense n_fine x n_coarse fine2coarse matrix."""
+        if self._matrix is None:
+            self._matrix = np.zeros((self.n_fine, self.n_coarse),
+                                    dtype=np.float32)
+            self._matrix[np.arange(self.n_fine), self.index] = 1
+        return self._matrix
+
+    @property
+    def sparse(self):
+        """fine2coarse matrix as a tf.sparse.SparseTensor."""
+        if self._sparse is None:
+            indices = np.stack([np.arange(self.n_fine), self.index], axis=1)
+            self._sparse = tf.sparse.SparseTensor(
+                indices=indices.astype(np.int64),
+                values=np.ones(self.n_fine, dtype=np.float32),
+                dense_shape=(self.n_fine, self.n_coarse))
+        return self._sparse
+
+    def coarse(self, y):
+        """Coarse labels of the integer fine labels `y`."""
+        return tf.gather(self.index, y)
+
+    def coarse_scores(self, fine_scores):
+        """Sums fine class scores (e.g. probabilities) into their coarse
+        classes.
+        """
+        return tf.sparse.sparse_dense_matmul(
+            tf.cast(fine_scores, tf.float32), self.sparse)
@@ -0,0 +1,214 @@
+import json
+import logging
+import multiprocessing
+import time
+
+import numpy as np
+import os
+import tensorflow as tf
+
+from .augment import AUGMENT_BATCH_SIZE, augment_batch
+from .preprocess import augmented_order, sparse_labels
+from .whitening import ZCATransform, covariance_from_moments, moments
+
+logger = logging.getLogger('parallel')
+
+PROGRESS = 'progress.json'
+
+# Transform loaded once per worker process
+_TRANSFORM = {}
+
+
+################################################################################
+#    Title: Preprocess parallel
+################################################################################
+#    Description:
+#        This function preprocesses a dataset into the cache format of
+#        preprocess_dataset_and_save with a pool of worker processes. The ZCA
+#        moments are accumulated over spans of the training set in parallel,
+#        then every chunk of images is whitened, augmented and written in place
+#        into preallocated .npy files. Chunks are aligned to the augmentation
+#        batches and the shuffle is the one of per_img_preprocess, so the
+#        arrays match the ones get_cifar100 builds sequentially. Completed
+#        stages and chunks are recorded in progress.json, so an interrupted
+#        run resumes where it stopped. Progress and per-stage timings are
+#        logged
+#
+#    Parameters:
+#        source            Picklable callable returning the memory-mapped
+#                          (x, y, y_c), (x_test, y_test, y_test_c) arrays,
+#                          called by every worker
+#        cache_dir         Cache variant directory written to
+#        whitening         Whether to ZCA whiten the images
+#        augmentation      'static' to store the augmented copy, 'online' to
+#                          store the images only
+#        seed              Seed of the augmentation and of the shuffle
+#        zca_components    Number of principal components kept by the ZCA
+#        storage           Dtype of the stored images, 'uint8' stores raw
+#                          images and only fits the whitening
+#        workers           Number of worker processes (defaults to the CPUs)
+#        chunk_size        Number of images per task, rounded up to a
+#                          multiple of AUGMENT_BATCH_SIZE
+#
+#    Returns:
+#        The per-stage timings in seconds
+################################################################################
+def preprocess_parallel(source, cache_dir, whitening=True,
+                        augmentation='static', seed=0, zca_components=None,
+                        storage='float32', workers=None, chunk_size=5120):
+    if chunk_size % AUGMENT_BATCH_SIZE:
+        chunk_size += AUGMENT_BATCH_SIZE - chunk_size % AUGMENT_BATCH_SIZE
+        logger.info(f'Rounding chunk_size up to {chunk_size}, a multiple of '
+                    f'the augmentation batch size')
+    os.makedirs(cache_dir, exist_ok=True)
+    progress = _read_progress(cache_dir)
+    if progress.setdefault('chunk_size', chunk_size) != chunk_size:
+        raise ValueError(f"Resuming a run made with chunk_size="
+                         f"{progress['chunk_size']}")
+    workers = workers or os.cpu_count()
+    (x, y, y_c), (x_test, y_test, y_test_c) = source()
+    n, n_test = len(x), len(x_test)
+    static = augmentation == 'static'
+
+    # Spawned workers do not inherit the TensorFlow state of this process
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(workers) as pool:
+        if 'labels' not in progress['timings']:
+            time1 = time.time()
+            y = sparse_labels(y)
+            if static:
+                positions = _positions(n, seed)
+                y_out = np.empty(2 * n, dtype=y.dtype)
+                y_out[positions] = np.concatenate([y, y])
+                y = y_out
+            np.save(os.path.join(cache_dir, 'y'), y)
+            np.save(os.path.join(cache_dir, 'y_test'), sparse_labels(y_test))
+            np.save(os.path.join(cache_dir, 'y_c'), np.asarray(y_c))
+            np.save(os.path.join(cache_dir, 'y_test_c'), np.asarray(y_test_c))
+            _done_stage(cache_dir, progress, 'labels', time.time() - time1)
+
+        if whitening and 'fit' not in progress['timings']:
+            time1 = time.time()
+            bounds = np.linspace(0, n, workers + 1).astype(int)
+            spans = [(source, int(a), int(b), chunk_size)
+                     for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+            sigma, total = 0, 0
+            for i, (s, t) in enumerate(pool.imap_unordered(_moments_task,
+                                                           spans)):
+                sigma, total = sigma + s, total + t
+                _log_progress('fit', i + 1, len(spans), time1)
+            mean, sigma = covariance_from_moments(
+                tf.constant(sigma), tf.constant(total), n)
+            transform = ZCATransform.from_covariance(
+                mean, sigma, n_components=zca_components)
+            transform.save(cache_dir)
+            _done_stage(cache_dir, progress, 'fit', time.time() - time1)
+
+        if 'write' not in progress['timings']:
+            time1 = time.time()
+            shape = x.shape[1:]
+            outputs = {'x': (2 * n if static else n,) + shape,
+                       'x_test': (n_test,) + shape}
+            for name, out_shape in outputs.items():
+                path = os.path.join(cache_dir, name + '.npy')
+                if not os.path.exists(path):
+                    np.lib.format.open_memmap(path, mode='w+', dtype=storage,
+                                              shape=out_shape)
+            whiten = whitening and storage != 'uint8'
+            tasks = []
+            for split, count in [('x', n), ('x_test', n_test)]:
+                done = set(progress['chunks'].get(split, []))
+                for start in range(0, count, chunk_size):
+                    if start not in done:
+                        tasks.append((source, cache_dir, split, start,
+                                      min(start + chunk_size, count),
+                                      whiten, static and split == 'x', seed))
+            n_chunks = sum((count + chunk_size - 1) // chunk_size
+                           for count in [n, n_test])
+            completed = n_chunks - len(tasks)
+            for split, start in pool.imap_unordered(_write_task, tasks):
+                progress['chunks'].setdefault(split, []).append(start)
+                _write_progress(cache_dir, progress)
+                completed += 1
+                _log_progress('write', completed, n_chunks, time1)
+            _done_stage(cache_dir, progress, 'write', time.time() - time1)
+
+    for stage, seconds in progress['timings'].items():
+        logger.info(f'Time Elapsed - {stage}: {seconds:.1f}s')
+    return progress['timings']
+
+
+def _positions(n, seed):
+    # Position in the output of every row of the concatenated augmented copy
+    # and originals, i.e. the inverse of the shuffle permutation
+    return np.argsort(augmented_order(n, seed))
+
+
+def _moments_task(args):
+    source, start, stop, chunk_size = args
+    (x, _, _), _ = source()
+    sigma, total = moments(x, start, stop, chunk_size)
+    return sigma.numpy(), total.numpy()
+
+
+def _write_task(args):
+    source, cache_dir, split, start, stop, whiten, static, seed = args
+    (x, _, _), (x_test, _, _) = source()
+    images = np.asarray((x if split == 'x' else x_test)[start:stop])
+    if whiten:
+        if cache_dir not in _TRANSFORM:
+            _TRANSFORM[cache_dir] = ZCATransform.load(cache_dir)
+        images = _TRANSFORM[cache_dir](images)
+
+    out = np.load(os.path.join(cache_dir, split + '.npy'), mmap_mode='r+')
+    if static:
+        n = len(x)
+        positions = _positions(n, seed)
+        # Same batches and seeds as augment_images over the whole set
+        for begin in range(start, stop, AUGMENT_BATCH_SIZE):
+            end = min(begin + AUGMENT_BATCH_SIZE, stop)
+            batch = images[begin - start:end - start]
+            index = begin // AUGMENT_BATCH_SIZE
+            net = augment_batch(batch, tf.constant([seed, index], tf.int64),
+                                flip_left_right=1., flip_up_down=.5, rot90=1.)
+            net1 = augment_batch(batch, tf.constant([seed + 1, index], tf.int64),
+                                 flip_left_right=0., flip_up_down=.5)
+            out[positions[begin:end]] = np.asarray(net, dtype=out.dtype)
+            out[positions[n + begin:n + end]] = np.asarray(net1,
+                                                           dtype=out.dtype)
+    else:
+        out[start:stop] = images
+    out.flush()
+    return split, start
+
+
+def _read_progress(cache_dir):
+    path = os.path.join(cache_dir, PROGRESS)
+    if os.path.exists(path):
+        with open(path) as f:
+            progress = json.load(f)
+        logger.info(f"Resuming preprocessing, done: "
+                    f"{', '.join(progress['timings']) or 'nothing'}")
+        return progress
+    return {'timings': {}, 'chunks': {}}
+
+
+def _write_progress(cache_dir, progress):
+    path = os.path.join(cache_dir, PROGRESS)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(progress, f)
+    os.replace(tmp, path)
+
+
+def _done_stage(cache_dir, progress, stage, seconds):
+    progress['timings'][stage] = seconds
+    _write_progress(cache_dir, progress)
+    logger.info(f'Stage {stage} done in {seconds:.1f}s')
+
+
+def _log_progress(stage, done, total, start):
+    elapsed = time.time() - start
+    eta = elapsed / done * (total - done)
+    logger.info(f'{stage}: {done}/{total} ({100 * done / total:.0f}%), '
+                f'{elapsed:.0f}s elapsed, {eta:.0f}s left')
@@ -0,0 +1,204 @@
+import logging
+
+import numpy as np
+import tensorflow as tf
+
+from .augment import augment_batch
+
+logger = logging.getLogger('pipeline')
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+# Rows read at once and number of concurrent reads when training out of core.
+# Fixed rather than autotuned so the memory held by the pipeline is bounded
+OUT_OF_CORE_CHUNK_SIZE = 2048
+PARALLEL_READS = 4
+PREFETCH_BATCHES = 2
+
+
+class ArrayView:
+    def __init__(self, array, indices=None):
+        """
+        Rows `indices` of `array`, read only when they are taken. Lets a
+        memory-mapped array be shuffled, split and sliced without copying it
+        """
+        self.array = array
+        if indices is None:
+            indices = np.arange(len(array))
+        self.indices = np.asarray(indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return self.array[self.indices[key]]
+        return ArrayView(self.array, self.indices[key])
+
+    def __array__(self, dtype=None):
+        out = self.take(np.arange(len(self.indices)))
+        return out if dtype is None else out.astype(dtype, copy=False)
+
+    @property
+    def shape(self):
+        return (len(self.indices),) + self.array.shape[1:]
+
+    @property
+    def dtype(self):
+        return self.array.dtype
+
+    def take(self, rows):
+        # Read the rows in storage order so a memory-mapped array is scanned
+        # forward, then put them back in the requested order
+        inds = self.indices[rows]
+        order = np.argsort(inds)
+        out = np.empty((len(inds),) + self.array.shape[1:], self.array.dtype)
+        out[order] = self.array[inds[order]]
+        return out
+
+
+################################################################################
+#    Title: Build dataset
+################################################################################
+#    Description:
+#        This function wraps inputs and targets into a tf.data pipeline that
+#        shuffles with a bounded buffer, batches, optionally
+#        augments and maps every batch in parallel and prefetches the next
+#        batches while the current one is being consumed. When an input is
+#        an ArrayView or a memory-mapped array, only the indices are
+#        shuffled and every batch reads its own rows, so the arrays are never
+#        materialized. With a chunk_size, such inputs are instead read out of
+#        core: contiguous chunks of rows are read forward in a random order by
+#        a few background readers and mixed in the bounded shuffle buffer, so
+#        the memory used does not depend on the dataset size (see
+#        memory_bound)
+#
+#    Parameters:
+#        inputs         Tensor (or tuple of tensors) fed to the model
+#        targets        Tensor (or tuple of tensors) used as labels
+#        batch_size     Number of samples per batch
+#        shuffle        Whether to shuffle the samples on every iteration
+#        seed           Seed of the shuffle and of the augmentation
+#        buffer_size    Size of the shuffle buffer
+#        map_fn         Function applied to every (inputs, targets) batch
+#        augment        Transform probabilities passed to augment_batch. The
+#                       images (first input) of every batch are augmented
+#                       when given
+#        transform      Function applied to the images of every batch before
+#                       augmenting them, e.g. ZCATransform.whiten_batch to
+#                       whiten images stored as uint8
+#        chunk_size     Number of contiguous rows read at once out of core
+#
+#    Returns:
+#        A tf.data.Dataset yielding (inputs, targets) batches
+################################################################################
+def build_dataset(inputs, targets, batch_size, shuffle=False, seed=0,
+                  buffer_size=10000, map_fn=None, augment=None,
+                  transform=None, chunk_size=None):
+    flat = tf.nest.flatten((inputs, targets))
+    indexed = any(isinstance(a, (ArrayView, np.memmap)) for a in flat)
+    prefetch = AUTOTUNE
+    if indexed and chunk_size is not None:
+        dataset = _chunked_dataset(inputs, targets, batch_size, shuffle, seed,
+                                   buffer_size, chunk_size)
+        prefetch = PREFETCH_BATCHES
+    elif indexed:
+        dataset = _indexed_dataset(inputs, targets, batch_size, shuffle, seed)
+    else:
+        dataset = tf.data.Dataset.from_tensor_slices((inputs, targets))
+        if shuffle:
+            dataset = dataset.shuffle(buffer_size, seed=seed,
+                                      reshuffle_each_iteration=True)
+        dataset = dataset.batch(batch_size)
+    if augment is not None or transform is not None:
+        dataset = dataset.enumerate().map(
+            lambda i, batch: _prepare(
+                batch, tf.stack([tf.constant(seed, tf.int64), i]), augment,
+                transform),
+            num_parallel_calls=AUTOTUNE)
+    if map_fn is not None:
+        dataset = dataset.map(map_fn, num_parallel_calls=AUTOTUNE)
+    return dataset.prefetch(prefetch)
+
+
+def memory_bound(x, batch_size, buffer_size, chunk_size):
+    """Approximate number of bytes of `x` held by an out-of-core pipeline
+    built with the same arguments: the rows of the concurrent chunk reads,
+    the shuffle buffer and the batches in flight. None when not out of core.
+    """
+    if chunk_size is None:
+        return None
+    row_bytes = int(np.prod(x.shape[1:])) * 4
+    rows = (PARALLEL_READS * chunk_size + buffer_size
+            + (PREFETCH_BATCHES + 2) * batch_size)
+    return rows * row_bytes
+
+
+def _prepare(batch, seed, augment, transform):
+    inputs, targets = batch
+    images = inputs[0] if isinstance(inputs, tuple) else inputs
+    if transform is not None:
+        images = transform(images)
+    if augment is not None:
+        images = augment_batch(images, seed, **augment)
+    if isinstance(inputs, tuple):
+        return (images,) + inputs[1:], targets
+    return images, targets
+
+
+def _reader(inputs, targets):
+    # Returns a function loading the given rows of every input and target as
+    # one graph op, casting floating arrays to float32
+    structure = (inputs, targets)
+    flat = [a if isinstance(a, (ArrayView, np.memmap)) else np.asarray(a)
+            for a in tf.nest.flatten(structure)]
+    dtypes = [tf.float32 if np.issubdtype(a.dtype, np.floating)
+              else tf.as_dtype(a.dtype) for a in flat]
+
+    def read(rows):
+        batch = []
+        for a, dtype in zip(flat, dtypes):
+            if isinstance(a, ArrayView):
+                rows_a = a.take(rows)
+            else:
+                order = np.argsort(rows)
+                rows_a = np.empty((len(rows),) + a.shape[1:], a.dtype)
+                rows_a[order] = a[rows[order]]
+            batch.append(rows_a.astype(dtype.as_numpy_dtype, copy=False))
+        return batch
+
+    def load(rows):
+        batch = tf.numpy_function(read, [rows], dtypes)
+        for tensor, a in zip(batch, flat):
+            tensor.set_shape((None,) + a.shape[1:])
+        return tf.nest.pack_sequence_as(structure, batch)
+
+    return load, len(flat[0])
+
+
+def _indexed_dataset(inputs, targets, batch_size, shuffle, seed):
+    load, n = _reader(inputs, targets)
+    dataset = tf.data.Dataset.range(n)
+    if shuffle:
+        dataset = dataset.shuffle(n, seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size)
+    return dataset.map(load, num_parallel_calls=AUTOTUNE)
+
+
+def _chunked_dataset(inputs, targets, batch_size, shuffle, seed, buffer_size,
+                     chunk_size):
+    load, n = _reader(inputs, targets)
+    n_chunks = (n + chunk_size - 1) // chunk_size
+    dataset = tf.data.Dataset.range(n_chunks)
+    if shuffle:
+        dataset = dataset.shuffle(n_chunks, seed=seed,
+                                  reshuffle_each_iteration=True)
+    dataset = dataset.map(
+        lambda c: load(tf.range(c * chunk_size,
+                                tf.minimum((c + 1) * chunk_size, n))),
+        num_parallel_calls=PARALLEL_READS)
+    dataset = dataset.unbatch()
+    if shuffle:
+        dataset = dataset.shuffle(buffer_size, seed=seed,
+                                  reshuffle_each_iteration=True)
+    return dataset.batch(batch_size)
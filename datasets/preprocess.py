@@ -1,10 +1,15 @@
 import logging
+import tempfile
 import time
 
 import numpy as np
 import os
 import tensorflow as tf
 
+from .augment import AUGMENT_BATCH_SIZE, augment_images
+from .pipeline import ArrayView
+from .whitening import ZCATransform
+
 logger = logging.getLogger('preprocess')
 
 
@@ -36,108 +41,226 @@ def train_test_split(data, test_size=.1):
     return (X_train, y_train), (X_val, y_val)
 
 
-def preprocess_dataset(x, y, x_test, y_test, whitening):
-    # One-hot
-    logger.debug(f'One hot: shape of y before: {y.shape}')
-    y = one_hot(y)
-    logger.debug(f'One hot: shape of y after: {y.shape}')
-    logger.debug(f'One hot: shape of y_test before: {y_test.shape}')
-    y_test = one_hot(y_test)
-    logger.debug(f'One hot: shape of y_test after: {y_test.shape}')
+def preprocess_dataset(x, y, x_test, y_test, whitening, augmentation='static',
+                       seed=0, zca_components=None, storage='float32'):
+    # Integer labels
+    y = sparse_labels(y)
+    y_test = sparse_labels(y_test)
 
     # ZCA whitening
+    transform = None
     if whitening:
         logger.info("ZCA whitening")
         time1 = time.time()
-        x, x_test = zca(x, x_test)
+        transform = ZCATransform.fit(x, n_components=zca_components)
+        if storage == 'uint8':
+            logger.info("Keeping uint8 images, they are whitened per batch")
+        else:
+            x, x_test = transform(x), transform(x_test)
         time2 = time.time()
         logger.info(f'Time Elapsed - ZCA Whitening: {time2 - time1}')
 
     # Per img preprocess
+    if augmentation == 'online':
+        logger.info("Skipping static augmentation, images are augmented "
+                    "online by the input pipeline")
+        return x, y, x_test, y_test, transform
     logger.info(
         "Pad images by 4 pixels, randomly crop them and then randomly flip them"
     )
     time1 = time.time()
-    x, y = per_img_preprocess(x, y)
+    x, y = per_img_preprocess(x, y, seed=seed)
     time2 = time.time()
     logger.info(f'Time Elapsed - Image augmentation: {time2 - time1}')
-    return x, y, x_test, y_test
+    return x, y, x_test, y_test, transform
 
 
 def preprocess_dataset_and_save(x, y, y_c, x_test, y_test, y_test_c,
-                                data_directory, whitening=False):
-    x, y, x_test, y_test = preprocess_dataset(x, y, x_test, y_test, whitening)
-    x_np = np.array(x)
+                                cache_dir, whitening=False,
+                                augmentation='static', seed=0,
+                                zca_components=None, storage='float32'):
+    x, y, x_test, y_test, transform = preprocess_dataset(
+        x, y, x_test, y_test, whitening, augmentation, seed, zca_components,
+        storage)
+    x_np = np.array(x, dtype=storage)
     y_np = np.array(y)
     y_c_np = np.array(y_c)
-    x_test_np = np.array(x_test)
+    x_test_np = np.array(x_test, dtype=storage)
     y_test_np = np.array(y_test)
     y_test_c_np = np.array(y_test_c)
 
-    os.makedirs(data_directory + '/preprocessed_data', exist_ok=True)
-    np.save(data_directory + '/preprocessed_data/x', x_np)
-    np.save(data_directory + '/preprocessed_data/x_test', x_test_np)
-    np.save(data_directory + '/preprocessed_data/y', y_np)
-    np.save(data_directory + '/preprocessed_data/y_test', y_test)
-    np.save(data_directory + '/preprocessed_data/y_c', y_c_np)
-    np.save(data_directory + '/preprocessed_data/y_test_c', y_test_c_np)
+    os.makedirs(cache_dir, exist_ok=True)
+    np.save(cache_dir + '/x', x_np)
+    np.save(cache_dir + '/x_test', x_test_np)
+    np.save(cache_dir + '/y', y_np)
+    np.save(cache_dir + '/y_test', y_test)
+    np.save(cache_dir + '/y_c', y_c_np)
+    np.save(cache_dir + '/y_test_c', y_test_c_np)
+    if transform is not None:
+        transform.save(cache_dir)
     return x, y, y_c, x_test, y_test, y_test_c
 
 
-def load_preprocessed_data(data_directory):
-    x = np.load(data_directory + '/preprocessed_data/x.npy')
+def load_preprocessed_data(cache_dir, mmap=False):
+    if mmap:
+        return load_mapped_preprocessed_data(cache_dir)
+    x = np.load(cache_dir + '/x.npy')
     x = tf.convert_to_tensor(x)
-    x_test = np.load(data_directory + '/preprocessed_data/x_test.npy')
+    x_test = np.load(cache_dir + '/x_test.npy')
     x_test = tf.convert_to_tensor(x_test)
-    y = np.load(data_directory + '/preprocessed_data/y.npy')
+    y = np.load(cache_dir + '/y.npy')
     y = tf.convert_to_tensor(y)
-    y_test = np.load(data_directory + '/preprocessed_data/y_test.npy')
+    y_test = np.load(cache_dir + '/y_test.npy')
     y_test = tf.convert_to_tensor(y_test)
-    y_c = np.load(data_directory + '/preprocessed_data/y_c.npy')
+    y_c = np.load(cache_dir + '/y_c.npy')
     y_c = tf.convert_to_tensor(y_c)
-    y_test_c = np.load(data_directory + '/preprocessed_data/y_test_c.npy')
+    y_test_c = np.load(cache_dir + '/y_test_c.npy')
     y_test_c = tf.convert_to_tensor(y_test_c)
     return x, y, y_c, x_test, y_test, y_test_c
 
 
+def load_mapped_preprocessed_data(cache_dir):
+    """Memory-maps the cached images instead of reading them. Pages are
+    only read from disk when a batch touches them, so nothing but the labels
+    is materialized at startup.
+    """
+    x = np.load(cache_dir + '/x.npy', mmap_mode='r')
+    x_test = np.load(cache_dir + '/x_test.npy', mmap_mode='r')
+    y = np.load(cache_dir + '/y.npy')
+    y_test = np.load(cache_dir + '/y_test.npy')
+    y_c = np.load(cache_dir + '/y_c.npy')
+    y_test_c = np.load(cache_dir + '/y_test_c.npy')
+    return x, y, y_c, x_test, y_test, y_test_c
+
+
+################################################################################
+#    Title: Stratified split
+################################################################################
+#    Description:
+#        This function splits sample indices into training and validation
+#        indices, drawing the same fraction of every fine class at random.
+#        Fine classes nest in coarse classes, so both levels of the hierarchy
+#        keep their proportions. Indices are returned sorted, so memory-mapped
+#        images are read forward
+#
+#    Parameters:
+#        y               Vector of M integer fine labels
+#        test_size       Fraction of every class used for validation
+#        random_state    Seed of the split
+#
+#    Returns:
+#        The sorted training indices and the sorted validation indices
+################################################################################
+def stratified_split(y, test_size=.1, random_state=0):
+    y = np.asarray(y).reshape(-1)
+    perm = np.random.RandomState(random_state).permutation(len(y))
+    # Samples grouped by class, in random order within every class
+    order = perm[np.argsort(y[perm], kind='stable')]
+    counts = np.bincount(y)
+    n_val = np.round(test_size * counts).astype(int)
+    is_val = _class_ranks(counts) < np.repeat(n_val, counts)
+    return np.sort(order[~is_val]), np.sort(order[is_val])
+
+
+def subset_indices(y, per_class):
+    """Sorted indices of the first `per_class` samples of every class."""
+    y = np.asarray(y).reshape(-1)
+    order = np.argsort(y, kind='stable')
+    keep = _class_ranks(np.bincount(y)) < per_class
+    return np.sort(order[keep])
+
+
+def _class_ranks(counts):
+    # Rank of every sample within its class, for samples grouped by class
+    starts = np.cumsum(counts) - counts
+    return np.arange(counts.sum()) - np.repeat(starts, counts)
+
+
+def split_indices(cache_dir, y, test_size=.1, random_state=0):
+    """Stratified split of `y` persisted in the cache variant `cache_dir`, so
+    every run trains and validates on the same samples.
+    """
+    path = os.path.join(cache_dir, f'split_{test_size}_{random_state}.npz')
+    if os.path.exists(path):
+        with np.load(path) as split:
+            return split['train'], split['val']
+    logger.info(f"Writing train/validation split to {path}")
+    inds_train, inds_val = stratified_split(y, test_size, random_state)
+    # A temporary file of its own, so concurrent runs never interleave writes
+    with tempfile.NamedTemporaryFile(dir=cache_dir, suffix='.tmp',
+                                     delete=False) as f:
+        np.savez(f, train=inds_train, val=inds_val)
+    # Readable by the other users of a shared variant, as open() would make it
+    os.chmod(f.name, 0o644)
+    os.replace(f.name, path)
+    return inds_train, inds_val
+
+
+def split_views(data, inds_train, inds_val, read_val=True):
+    """Splits `data` along precomputed indices. The training images are an
+    ArrayView over `X` instead of a gathered copy; the validation images are
+    read unless `read_val` is False.
+    """
+    X, y = data
+    if not isinstance(X, np.ndarray):
+        X = np.asarray(X)
+    y = np.asarray(y)
+
+    X_train = ArrayView(X, inds_train)
+    X_val = ArrayView(X, inds_val)
+    if read_val:
+        X_val = np.asarray(X_val, dtype=np.float32)
+
+    return (X_train, y[inds_train]), (X_val, y[inds_val])
+
+
 ###############################################################################
 #    Title: ZCA
 ###############################################################################
 #    Description:
-#        This function applies ZCA Whitening to the image set
+#        This function applies ZCA Whitening to the image set. The transform
+#        is fitted and applied chunk by chunk so no full floating point copy
+#        of either image set is made
 #
 #    Parameters:
 #        x_1           Array of MxNxC images to compute the ZCA Whitening
 #        x_2           Array of MxNxC images to apply the ZCA transform
-#        num_batch    Number of batches to do the computation
+#        epsilon       Regularization added to the eigenvalues
+#        chunk_size    Number of images processed at once
+#        dtype         Accumulation dtype of the covariance (tf.float64 or
+#                      tf.float32)
 #
 #    Returns:
-#        An array of MxNxC zca whitened images
+#        Two arrays of MxNxC zca whitened images
 ###############################################################################
-@tf.function
-def zca(x_1, x_2, epsilon=1e-5):
+def zca(x_1, x_2, epsilon=1e-5, chunk_size=5000, dtype=tf.float64):
     with tf.name_scope('ZCA'):
-        flatx = tf.cast(tf.reshape(
-            x_1, (-1, np.prod(x_1.shape[-3:])), name="reshape_flat"),
-            tf.float64, name="flatx")
-        sigma = tf.tensordot(tf.transpose(flatx), flatx, 1, name="sigma") / \
-                tf.cast(tf.shape(flatx)[0], tf.float64)  # N-1 or N?
-        s, u, v = tf.linalg.svd(sigma, name="svd")
-        pc = tf.tensordot(tf.tensordot(u, tf.linalg.diag(
-            1. / tf.math.sqrt(s + epsilon)), 1, name="inner_dot"),
-                          tf.transpose(u), 1, name="pc")
-
-        net1 = tf.tensordot(flatx, pc, 1, name="whiten1")
-        net1 = tf.reshape(net1, np.shape(x_1), name="output1")
-
-        flatx2 = tf.cast(tf.reshape(
-            x_2, (-1, np.prod(x_2.shape[-3:])), name="reshape_flat2"),
-            tf.float64, name="flatx2")
-        net2 = tf.tensordot(flatx2, pc, 1, name="whiten2")
-        net2 = tf.reshape(net2, np.shape(x_2), name="output2")
+        transform = ZCATransform.fit(x_1, epsilon=epsilon,
+                                     chunk_size=chunk_size, dtype=dtype)
+        net1 = transform(x_1, chunk_size=chunk_size)
+        net2 = transform(x_2, chunk_size=chunk_size)
     return net1, net2
 
 
+################################################################################
+#    Title: Sparse labels
+################################################################################
+#    Description:
+#        This function flattens a column of label values into a vector of
+#        integer labels, the representation used for training with sparse
+#        categorical cross-entropy
+#
+#    Parameters:
+#        y    Array of Mx1 label values
+#
+#    Returns:
+#        y_new    Vector of M int32 labels
+################################################################################
+def sparse_labels(y):
+    y_new = np.asarray(y).reshape(-1).astype(np.int32)
+    return y_new
+
+
 ################################################################################
 #    Title: One Hot Encoding
 ################################################################################
@@ -145,14 +268,17 @@ def zca(x_1, x_2, epsilon=1e-5):
 #        This function extends a matrix to one-hot encoding
 #
 #    Parameters:
-#        y    Array of label values
+#        y           Array of label values, Mx1 or a vector of M labels
+#        n_values    Number of classes (defaults to the largest label + 1)
 #
 #    Returns:
 #        y_new    One hot encoded array of labels
 ################################################################################
-def one_hot(y):
-    n_values = np.max(y) + 1
-    y_new = np.eye(n_values)[y[:, 0]]
+def one_hot(y, n_values=None):
+    y = np.asarray(y).reshape(-1)
+    if n_values is None:
+        n_values = np.max(y) + 1
+    y_new = np.eye(n_values, dtype=np.float32)[y]
     return y_new
 
 
@@ -160,45 +286,38 @@ def one_hot(y):
 #    Title: Per img preprocess
 ################################################################################
 #    Description:
-#        This function pads images by 4 pixels, randomly crops them, then
-#        randomly flips them
+#        This function builds an augmented copy of the images (flipped,
+#        rotated, padded by 4 pixels and randomly cropped), concatenates it
+#        with randomly cropped originals, shuffles the result and randomly
+#        flips it upside down. The transforms run batch-wise through
+#        augment_images and the shuffle is augmented_order, which
+#        preprocess_parallel follows to write the same arrays
 #
 #    Parameters:
-#        x_1           Array of MxNxC images to compute the ZCA Whitening
-#        x_2           Array of MxNxC images to apply the ZCA transform
-#        num_batch    Number of batches to do the computation
+#        X             Array of MxNxC images
+#        y             Array of labels of the images
+#        seed          Seed of the augmentation and of the shuffle
+#        batch_size    Number of images augmented per batch
 #
 #    Returns:
-#        An array of MxNxC zca whitened images
+#        An array of 2MxNxC augmented images and their labels
 ################################################################################
-
-
-@tf.function
-def per_img_preprocess(X, y):
+def per_img_preprocess(X, y, seed=0, batch_size=AUGMENT_BATCH_SIZE):
     with tf.name_scope('Preproc'):
-        net = tf.map_fn(lambda img: tf.image.flip_left_right(img), X)
-        net = tf.map_fn(lambda img: tf.image.rot90(img), net)
-        net = tf.image.resize_with_crop_or_pad(net, 40, 40)
-        net = tf.map_fn(lambda img: tf.image.random_crop(
-            img, [32, 32, 3]), net)
-        net1 = tf.image.resize_with_crop_or_pad(X, 40, 40)
-        net1 = tf.map_fn(lambda img: tf.image.random_crop(
-            img, [32, 32, 3]), net1)
+        net = augment_images(X, batch_size=batch_size, seed=seed,
+                             flip_left_right=1., flip_up_down=.5, rot90=1.)
+        net1 = augment_images(X, batch_size=batch_size, seed=seed + 1,
+                              flip_left_right=0., flip_up_down=.5)
         net = tf.concat([net, net1], 0)
-        net = tf.random.shuffle(net, seed=0)
         net_labels = tf.concat([y, y], 0)
-        net_labels = tf.random.shuffle(net_labels, seed=0)
-        net = tf.map_fn(lambda img: tf.image.random_flip_up_down(img), net)
+        inds = augmented_order(len(y), seed)
+        net = tf.gather(net, inds)
+        net_labels = tf.gather(net_labels, inds)
     return net, net_labels
 
 
-def build_fine2coarse_matrix(y, y_c):
-    fine_categories = len(np.unique(y))
-    coarse_categories = len(np.unique(y_c))
-    fine2coarse = np.zeros((fine_categories, coarse_categories), dtype=np.float32)
-    for i in range(coarse_categories):
-        index = np.where(y_c[:, 0] == i)[0]
-        fine_cat = np.unique([y[j, 0] for j in index])
-        for j in fine_cat:
-            fine2coarse[j, i] = 1
-    return fine2coarse
+def augmented_order(n, seed=0):
+    """Shuffle of the augmented copy of `n` images concatenated with the
+    originals: row i of the output is row order[i] of the concatenation.
+    """
+    return np.random.RandomState(seed).permutation(2 * n)
@@ -0,0 +1,43 @@
+import numpy as np
+import tensorflow as tf
+
+from .pipeline import ArrayView
+
+
+class IndexSampler(tf.keras.utils.Sequence):
+    def __init__(self, inputs, targets, batch_size, seed=0):
+        """
+        Feeds Keras fit with shuffled batches without permuting the arrays.
+        Only a permutation of the sample indices is drawn every epoch, and each
+        batch gathers its own rows from `inputs` and `targets` (tensors,
+        arrays or ArrayViews, nested in lists or tuples)
+        """
+        self.inputs = inputs
+        self.targets = targets
+        self.batch_size = batch_size
+        self.seed = seed
+        self.epoch = 0
+        self.n = len(tf.nest.flatten(inputs)[0])
+        self.indices = None
+        self.on_epoch_end()
+
+    def __len__(self):
+        return (self.n + self.batch_size - 1) // self.batch_size
+
+    def __getitem__(self, i):
+        rows = self.indices[i * self.batch_size:(i + 1) * self.batch_size]
+        return (tf.nest.map_structure(lambda a: _take(a, rows), self.inputs),
+                tf.nest.map_structure(lambda a: _take(a, rows), self.targets))
+
+    def on_epoch_end(self):
+        random_state = np.random.RandomState([self.seed, self.epoch])
+        self.indices = random_state.permutation(self.n)
+        self.epoch += 1
+
+
+def _take(a, rows):
+    if isinstance(a, ArrayView):
+        return a.take(rows)
+    if isinstance(a, np.ndarray):
+        return a[rows]
+    return tf.gather(a, rows)
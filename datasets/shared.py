@@ -0,0 +1,102 @@
+import json
+import logging
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+import os
+
+logger = logging.getLogger('shared')
+
+SPEC = 'shared.json'
+
+# Segments attached by this process, kept alive as long as the process runs
+# since the arrays handed out are views of their buffers
+_ATTACHED = {}
+
+
+class SharedArrays:
+    def __init__(self, shm, arrays, directory, owner=False):
+        """
+        Named arrays laid out in one shared memory segment. The hosting
+        process creates the segment and describes it in a spec file under
+        `directory`; other processes attach to it and get read-only views,
+        so the arrays are held in memory once however many processes use them
+        """
+        self.shm = shm
+        self.arrays = arrays
+        self.directory = directory
+        self.owner = owner
+
+    @classmethod
+    def host(cls, directory, name, arrays):
+        specs = {}
+        offset = 0
+        for key, a in arrays.items():
+            dtype = np.dtype(a.dtype)
+            # Keep every array aligned on its item size
+            offset = -(-offset // dtype.itemsize) * dtype.itemsize
+            specs[key] = {'shape': list(a.shape), 'dtype': str(dtype),
+                          'offset': offset}
+            offset += int(np.prod(a.shape)) * dtype.itemsize
+
+        logger.info(f'Hosting {offset / 2 ** 20:.0f} MB in shared memory '
+                    f'segment {name}')
+        shm = shared_memory.SharedMemory(name=name, create=True,
+                                         size=max(offset, 1))
+        views = _views(shm, specs)
+        for key, a in arrays.items():
+            views[key][...] = a
+            views[key].flags.writeable = False
+
+        # The spec is written last, once the segment is filled
+        path = os.path.join(directory, SPEC)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'name': name, 'arrays': specs}, f, indent=2)
+        os.replace(tmp, path)
+        return cls(shm, views, directory, owner=True)
+
+    @classmethod
+    def attach(cls, directory):
+        """Returns the arrays hosted for `directory`, or None when nothing is
+        hosted.
+        """
+        if directory in _ATTACHED:
+            return _ATTACHED[directory]
+        path = os.path.join(directory, SPEC)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            spec = json.load(f)
+        try:
+            shm = shared_memory.SharedMemory(name=spec['name'])
+        except FileNotFoundError:
+            logger.warning(f"Stale shared dataset spec {path}, the host "
+                           f"is gone")
+            return None
+        # Attaching registers the segment with this process' resource
+        # tracker, which would unlink it when the process exits
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        views = _views(shm, spec['arrays'])
+        for a in views.values():
+            a.flags.writeable = False
+        logger.info(f"Attached to shared memory segment {spec['name']}")
+        shared = cls(shm, views, directory)
+        _ATTACHED[directory] = shared
+        return shared
+
+    def close(self):
+        """Releases the segment; the host also removes it and its spec."""
+        self.arrays = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+            path = os.path.join(self.directory, SPEC)
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def _views(shm, specs):
+    return {key: np.ndarray(s['shape'], dtype=s['dtype'], buffer=shm.buf,
+                            offset=s['offset'])
+            for key, s in specs.items()}
@@ -0,0 +1,165 @@
+import json
+import logging
+
+import numpy as np
+import os
+import tensorflow as tf
+
+from .whitening import ZCATransform
+
+logger = logging.getLogger('tfrecord')
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+FEATURES = {
+    'image': tf.io.FixedLenFeature([], tf.string),
+    'label': tf.io.FixedLenFeature([], tf.int64),
+    'coarse_label': tf.io.FixedLenFeature([], tf.int64),
+}
+
+
+################################################################################
+#    Title: Export TFRecords
+################################################################################
+#    Description:
+#        This function writes an image set with its fine and coarse labels as
+#        N compressed TFRecord shards, one record per image, and a
+#        <name>.json spec listing the shards with the image shape and dtype.
+#        Images are read chunk by chunk, so memory-mapped arrays and
+#        ArrayViews are never materialized. Raw images are exported with the
+#        whitening transform, saved next to the shards and applied by
+#        load_tfrecords
+#
+#    Parameters:
+#        directory      Directory the shards are written to
+#        name           Name of the split (train, val, test)
+#        x              Array of MxHxWxC images
+#        y              Vector of M integer fine labels
+#        y_c            Vector of M integer coarse labels
+#        n_shards       Number of shards
+#        compression    TFRecord compression type ('GZIP', 'ZLIB' or '')
+#        chunk_size     Number of images read at once
+#        whitening      ZCATransform of raw images, None when they are
+#                       already whitened
+#
+#    Returns:
+#        The spec of the exported split
+################################################################################
+def export_tfrecords(directory, name, x, y, y_c, n_shards=16,
+                     compression='GZIP', chunk_size=1000, whitening=None):
+    os.makedirs(directory, exist_ok=True)
+    if whitening is not None:
+        whitening.save(directory)
+    n = len(x)
+    y = np.asarray(y).reshape(-1)
+    y_c = np.asarray(y_c).reshape(-1)
+    dtype = np.asarray(x[:1]).dtype
+    options = tf.io.TFRecordOptions(compression_type=compression)
+
+    bounds = np.linspace(0, n, n_shards + 1).astype(int)
+    files = []
+    for shard in range(n_shards):
+        filename = f'{name}-{shard:05d}-of-{n_shards:05d}.tfrecord'
+        logger.debug(f'Writing {filename}')
+        with tf.io.TFRecordWriter(os.path.join(directory, filename),
+                                  options) as writer:
+            for start in range(bounds[shard], bounds[shard + 1], chunk_size):
+                stop = min(start + chunk_size, bounds[shard + 1])
+                images = np.asarray(x[start:stop], dtype=dtype)
+                for i, image in enumerate(images):
+                    writer.write(_example(image, y[start + i],
+                                          y_c[start + i]))
+        files.append(filename)
+
+    spec = {'n': n,
+            'shape': [int(d) for d in x.shape[1:]],
+            'dtype': str(dtype),
+            'compression': compression,
+            'whitening': whitening is not None,
+            'files': files}
+    # The spec is written last and marks the split complete
+    with open(os.path.join(directory, name + '.json'), 'w') as f:
+        json.dump(spec, f, indent=2)
+    logger.info(f'Exported {n} {name} images to {n_shards} shards')
+    return spec
+
+
+def _example(image, label, coarse_label):
+    feature = {
+        'image': tf.train.Feature(
+            bytes_list=tf.train.BytesList(value=[image.tobytes()])),
+        'label': tf.train.Feature(
+            int64_list=tf.train.Int64List(value=[int(label)])),
+        'coarse_label': tf.train.Feature(
+            int64_list=tf.train.Int64List(value=[int(coarse_label)])),
+    }
+    return tf.train.Example(
+        features=tf.train.Features(feature=feature)).SerializeToString()
+
+
+################################################################################
+#    Title: Load TFRecords
+################################################################################
+#    Description:
+#        This function reads a split exported by export_tfrecords. Shards are
+#        read in parallel and interleaved, records are batched before being
+#        parsed so every batch is decoded by a single op, raw images are
+#        whitened with the transform exported with them, and the next
+#        batches are prefetched
+#
+#    Parameters:
+#        directory       Directory holding the shards
+#        name            Name of the split
+#        batch_size      Number of samples per batch
+#        shuffle         Whether to shuffle the shards and the records on
+#                        every iteration
+#        seed            Seed of the shuffle
+#        buffer_size     Size of the record shuffle buffer
+#        cycle_length    Number of shards read concurrently
+#        map_fn          Function applied to every (images, labels,
+#                        coarse_labels) batch, e.g. to build the inputs and
+#                        targets of a model
+#
+#    Returns:
+#        A tf.data.Dataset yielding (images, labels, coarse_labels) batches,
+#        or whatever map_fn returns
+################################################################################
+def load_tfrecords(directory, name, batch_size, shuffle=False, seed=0,
+                   buffer_size=10000, cycle_length=4, map_fn=None):
+    with open(os.path.join(directory, name + '.json')) as f:
+        spec = json.load(f)
+    dtype = tf.as_dtype(spec['dtype'])
+    shape = spec['shape']
+    transform = None
+    if spec.get('whitening'):
+        transform = ZCATransform.load(directory)
+
+    files = [os.path.join(directory, filename) for filename in spec['files']]
+    dataset = tf.data.Dataset.from_tensor_slices(files)
+    if shuffle:
+        dataset = dataset.shuffle(len(files), seed=seed,
+                                  reshuffle_each_iteration=True)
+    dataset = dataset.interleave(
+        lambda path: tf.data.TFRecordDataset(
+            path, compression_type=spec['compression']),
+        cycle_length=cycle_length, num_parallel_calls=AUTOTUNE)
+    if shuffle:
+        dataset = dataset.shuffle(buffer_size, seed=seed,
+                                  reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size)
+
+    def parse(records):
+        example = tf.io.parse_example(records, FEATURES)
+        images = tf.io.decode_raw(example['image'], dtype)
+        images = tf.reshape(images, [-1] + shape)
+        if transform is not None:
+            images = transform.whiten_batch(images)
+        elif dtype.is_floating:
+            images = tf.cast(images, tf.float32)
+        return (images, tf.cast(example['label'], tf.int32),
+                tf.cast(example['coarse_label'], tf.int32))
+
+    dataset = dataset.map(parse, num_parallel_calls=AUTOTUNE)
+    if map_fn is not None:
+        dataset = dataset.map(map_fn, num_parallel_calls=AUTOTUNE)
+    return dataset.prefetch(AUTOTUNE)
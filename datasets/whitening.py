@@ -0,0 +1,270 @@
+import logging
+
+import numpy as np
+import os
+import tensorflow as tf
+
+logger = logging.getLogger('whitening')
+
+
+class ZCATransform:
+    def __init__(self, mean, matrix=None, components=None, scales=None,
+                 retained_variance=1.):
+        """
+        Fitted ZCA whitening: images are flattened, centered with `mean` and
+        multiplied by the DxD whitening `matrix`. A low-rank transform keeps
+        the DxK top `components` and their K `scales` instead, and whitens
+        with two thin matmuls
+        """
+        self.mean = np.asarray(mean)
+        self.components = None if components is None else np.asarray(components)
+        self.scales = None if scales is None else np.asarray(scales)
+        self._matrix = None if matrix is None else np.asarray(matrix)
+        self.retained_variance = retained_variance
+
+    @property
+    def matrix(self):
+        if self._matrix is None:
+            self._matrix = np.dot(self.components * self.scales,
+                                  self.components.T)
+        return self._matrix
+
+    @property
+    def low_rank(self):
+        return self.components is not None
+
+    @classmethod
+    def fit(cls, x, epsilon=1e-5, chunk_size=5000, dtype=tf.float64,
+            center=False, n_components=None):
+        mean, sigma = _covariance(x, chunk_size, dtype, center)
+        return cls.from_covariance(mean, sigma, epsilon, n_components)
+
+    @classmethod
+    def from_covariance(cls, mean, sigma, epsilon=1e-5, n_components=None):
+        """Transform of the images whose mean and DxD covariance (second
+        moment when not centering) are given, e.g. accumulated in parallel.
+        """
+        if n_components is None:
+            pc = _zca_matrix(sigma, epsilon)
+            return cls(np.asarray(mean), pc.numpy())
+        components, scales, retained = _zca_components(sigma, n_components,
+                                                       epsilon)
+        logger.info(f'ZCA keeps {n_components} components, '
+                    f'{100 * retained:.2f}% of the variance')
+        return cls(np.asarray(mean), components=components.numpy(),
+                   scales=scales.numpy(), retained_variance=retained)
+
+    def __call__(self, x, chunk_size=5000, out_dtype=np.float32):
+        """Whitens a whole image set, raw uint8 or float, chunk by chunk."""
+        if self.low_rank:
+            return zca_apply(x, self.components, mean=self.mean,
+                             chunk_size=chunk_size, out_dtype=out_dtype,
+                             scales=self.scales)
+        return zca_apply(x, self.matrix, mean=self.mean,
+                         chunk_size=chunk_size, out_dtype=out_dtype)
+
+    def whiten_batch(self, images):
+        """Graph version of the transform, usable inside a tf.data map."""
+        shape = tf.shape(images)
+        flat = tf.reshape(tf.cast(images, tf.float32), (shape[0], -1))
+        flat -= self.mean.astype(np.float32)
+        if self.low_rank:
+            components = self.components.astype(np.float32)
+            flat = tf.linalg.matmul(
+                tf.linalg.matmul(flat, components) * self.scales.astype(np.float32),
+                components, transpose_b=True)
+        else:
+            flat = tf.linalg.matmul(flat, self.matrix.astype(np.float32))
+        return tf.reshape(flat, shape)
+
+    def save(self, directory):
+        np.save(os.path.join(directory, 'zca_mean'), self.mean)
+        if self.low_rank:
+            np.save(os.path.join(directory, 'zca_components'), self.components)
+            np.save(os.path.join(directory, 'zca_scales'), self.scales)
+        else:
+            np.save(os.path.join(directory, 'zca_matrix'), self.matrix)
+
+    @classmethod
+    def load(cls, directory):
+        """Returns the transform saved in `directory`, or None if there is
+        none.
+        """
+        mean_path = os.path.join(directory, 'zca_mean.npy')
+        if not os.path.exists(mean_path):
+            return None
+        mean = np.load(mean_path)
+        path = os.path.join(directory, 'zca_matrix.npy')
+        if os.path.exists(path):
+            return cls(mean, np.load(path))
+        return cls(mean,
+                   components=np.load(os.path.join(directory, 'zca_components.npy')),
+                   scales=np.load(os.path.join(directory, 'zca_scales.npy')))
+
+
+###############################################################################
+#    Title: ZCA fit
+###############################################################################
+#    Description:
+#        This function computes the ZCA whitening matrix of an image set. The
+#        covariance is accumulated over chunks of images, so memory is
+#        bounded by one chunk and the DxD covariance, D = N*M*C
+#
+#    Parameters:
+#        x             Array of MxNxC images
+#        epsilon       Regularization added to the eigenvalues
+#        chunk_size    Number of images accumulated at once
+#        dtype         Accumulation dtype of the covariance
+#        center        Whether to subtract the mean image before whitening
+#
+#    Returns:
+#        The mean image (zeros when not centering) flattened to D values and
+#        the DxD ZCA whitening matrix
+###############################################################################
+def zca_fit(x, epsilon=1e-5, chunk_size=5000, dtype=tf.float64, center=False):
+    mean, sigma = _covariance(x, chunk_size, dtype, center)
+    return mean, _zca_matrix(sigma, epsilon)
+
+
+def _zca_matrix(sigma, epsilon):
+    s, u, v = tf.linalg.svd(sigma, name="svd")
+    return tf.linalg.matmul(u * (1. / tf.math.sqrt(s + epsilon)), u,
+                            transpose_b=True, name="pc")
+
+
+###############################################################################
+#    Title: ZCA fit low rank
+###############################################################################
+#    Description:
+#        This function computes a rank K approximation of the ZCA whitening
+#        matrix from the top K eigenvectors of the covariance, found by
+#        randomized subspace iteration in O(D*D*K) instead of the O(D^3) of a
+#        full eigendecomposition. Whitening then costs 2*D*K instead of D*D
+#        multiply-adds per image
+#
+#    Parameters:
+#        x               Array of MxNxC images
+#        n_components    Number K of principal components kept
+#        epsilon         Regularization added to the eigenvalues
+#        chunk_size      Number of images accumulated at once
+#        dtype           Accumulation dtype of the covariance
+#        center          Whether to subtract the mean image before whitening
+#
+#    Returns:
+#        The mean image flattened to D values, the DxK top components, their
+#        K whitening scales and the fraction of the variance they retain
+###############################################################################
+def zca_fit_low_rank(x, n_components, epsilon=1e-5, chunk_size=5000,
+                     dtype=tf.float64, center=False):
+    mean, sigma = _covariance(x, chunk_size, dtype, center)
+    components, scales, retained = _zca_components(sigma, n_components,
+                                                   epsilon)
+    return mean, components, scales, retained
+
+
+def _zca_components(sigma, n_components, epsilon, oversampling=10,
+                    n_iter=None):
+    d = int(sigma.shape[0])
+    size = n_components + oversampling
+    if 2 * size >= d:
+        # Close to full rank the iteration costs more than the full
+        # decomposition
+        e, u = tf.linalg.eigh(sigma, name="eigh")
+    else:
+        if n_iter is None:
+            # Smaller subspaces need more iterations to separate the
+            # components at the cut from the next ones
+            n_iter = 7 if n_components < .1 * d else 4
+        # Fixed start, so the same covariance always gives the same transform
+        q = tf.constant(np.random.RandomState(0).standard_normal((d, size)),
+                        dtype=sigma.dtype)
+        for _ in range(n_iter):
+            q, _ = tf.linalg.qr(tf.linalg.matmul(sigma, q))
+        # Rayleigh-Ritz: eigenvectors of the covariance restricted to the
+        # subspace, mapped back to D dimensions
+        projected = tf.linalg.matmul(q, tf.linalg.matmul(sigma, q),
+                                     transpose_a=True)
+        e, v = tf.linalg.eigh(projected, name="eigh")
+        u = tf.linalg.matmul(q, v)
+    # Eigenvalues come in ascending order
+    e = tf.maximum(e, 0)
+    top_e = e[-n_components:]
+    components = u[:, -n_components:]
+    scales = 1. / tf.math.sqrt(top_e + epsilon)
+    # The trace is the total variance without every eigenvalue
+    retained = float(tf.reduce_sum(top_e) / tf.linalg.trace(sigma))
+    return components, scales, retained
+
+
+def _covariance(x, chunk_size, dtype, center):
+    sigma, total = moments(x, 0, len(x), chunk_size, dtype)
+    return covariance_from_moments(sigma, total, len(x), center)
+
+
+def moments(x, start, stop, chunk_size=5000, dtype=tf.float64):
+    """Sums of the outer products and of the flattened images of rows
+    `start:stop` of `x`. Sums over disjoint row ranges add up to those of the
+    whole set.
+    """
+    d = int(np.prod(x.shape[-3:]))
+    sigma = tf.zeros((d, d), dtype=dtype)
+    total = tf.zeros((d,), dtype=dtype)
+    for begin in range(start, stop, chunk_size):
+        end = min(begin + chunk_size, stop)
+        flatx = tf.reshape(tf.cast(x[begin:end], dtype),
+                           (-1, d), name="reshape_flat")
+        sigma += tf.linalg.matmul(flatx, flatx, transpose_a=True,
+                                  name="sigma")
+        total += tf.reduce_sum(flatx, axis=0)
+    return sigma, total
+
+
+def covariance_from_moments(sigma, total, n, center=False):
+    dtype = sigma.dtype
+    sigma = sigma / tf.cast(n, dtype)  # N-1 or N?
+    mean = total / tf.cast(n, dtype)
+    if center:
+        sigma -= mean[:, None] * mean[None, :]
+    else:
+        mean = tf.zeros_like(mean)
+    return mean, sigma
+
+
+###############################################################################
+#    Title: ZCA apply
+###############################################################################
+#    Description:
+#        This function whitens an image set with a ZCA matrix, one chunk at a
+#        time, writing into a preallocated output array
+#
+#    Parameters:
+#        x             Array of MxNxC images
+#        pc            DxD ZCA whitening matrix, or DxK components when
+#                      scales is given
+#        mean          Mean image flattened to D values
+#        chunk_size    Number of images whitened at once
+#        out_dtype     Dtype of the whitened images
+#        scales        K whitening scales of a low-rank transform
+#
+#    Returns:
+#        An array of MxNxC zca whitened images
+###############################################################################
+def zca_apply(x, pc, mean=None, chunk_size=5000, out_dtype=np.float32,
+              scales=None):
+    n = len(x)
+    d = int(np.prod(x.shape[-3:]))
+    out = np.empty((n,) + tuple(x.shape[1:]), dtype=out_dtype)
+    flat_out = out.reshape(n, d)
+    for start in range(0, n, chunk_size):
+        flatx = tf.reshape(tf.cast(x[start:start + chunk_size], pc.dtype),
+                           (-1, d), name="reshape_flat")
+        if mean is not None:
+            flatx -= tf.cast(mean, flatx.dtype)
+        if scales is None:
+            flatx = tf.linalg.matmul(flatx, pc, name="whiten")
+        else:
+            flatx = tf.linalg.matmul(
+                tf.linalg.matmul(flatx, pc, name="project") * scales, pc,
+                transpose_b=True, name="whiten")
+        flat_out[start:start + chunk_size] = flatx.numpy()
+    return out
@@ -5,3 +5,4 @@ from .vanilla_cnn import VanillaCNN
 from models.h_resnet import HResNet
 from .hat_cnn import HatCNN
 from .h_cnn import HCNN
+from .trainer import HierarchicalTrainer
@@ -6,9 +6,13 @@ import os
 import tensorflow as tf
 
 import utils
+from models.plugins import ResumeCheckpoint
 
 logger = logging.getLogger('HDCNNBaseline')
 
+# Training stages, in the order the script runs them
+STAGES = ['shared', 'coarse', 'fine']
+
 
 class HDCNN:
     def __init__(self, n_fine_categories, n_coarse_categories,
@@ -39,6 +43,11 @@ class HDCNN:
             model_i = self.build_fine_classifier()
             self.fine_classifiers['models'][i] = model_i
 
+        # The model files are prefixed with the run timestamp, the resume
+        # checkpoint is shared by the runs of the same name
+        self.checkpoint = ResumeCheckpoint(
+            os.path.join(os.path.dirname(model_directory), 'resume'))
+
         self.tbCallBack = tf.keras.callbacks.TensorBoard(
             log_dir=logs_directory, histogram_freq=0,
             write_graph=True, write_images=True)
@@ -81,6 +90,12 @@ class HDCNN:
                                      loss='categorical_crossentropy',
                                      metrics=['accuracy'])
         index = p['initial_epoch']
+        progress = self.restore_progress('shared', sgd_coarse=sgd_coarse)
+        if progress is not None:
+            if progress['stage'] != 'shared':
+                logger.info('Shared layers already trained')
+                return
+            index = progress['epoch']
         while index < p['stop']:
             self.full_classifier.fit(x_train, y_train,
                                      batch_size=p['batch_size'],
@@ -92,6 +107,7 @@ class HDCNN:
             self.save_model(os.path.join(self.model_directory,
                                          f"full_classifier_{index}"),
                             self.full_classifier)
+            self.save_progress('shared', index, sgd_coarse=sgd_coarse)
 
     def train_coarse_classifier(self, training_data, validation_data,
                                 fine2coarse):
@@ -101,20 +117,31 @@ class HDCNN:
         x_val, y_val = validation_data
 
         logger.info("Transforming fine to coarse labels")
-        y_train_c = np.dot(y_train, fine2coarse)
-        y_val_c = np.dot(y_val, fine2coarse)
+        y_train_c = np.dot(y_train, fine2coarse.matrix)
+        y_val_c = np.dot(y_val, fine2coarse.matrix)
 
         p = self.coarse_training_params
 
-        # Coarse training
-        logger.info('Coarse training')
         sgd_coarse = tf.keras.optimizers.SGD(
             lr=0.01, decay=1e-6, momentum=0.9, nesterov=True)
+        sgd_fine = tf.keras.optimizers.SGD(
+            lr=0.001, decay=1e-6, momentum=0.9, nesterov=True)
+
+        index = self.shared_training_params['stop']
+        progress = self.restore_progress('coarse', sgd_coarse=sgd_coarse,
+                                         sgd_fine=sgd_fine)
+        if progress is not None:
+            if progress['stage'] != 'coarse':
+                logger.info('Coarse classifier already trained')
+                return
+            index = progress['epoch']
+
+        # Coarse training
+        logger.info('Coarse training')
         self.coarse_classifier.compile(optimizer=sgd_coarse,
                                        loss='categorical_crossentropy',
                                        metrics=['accuracy'])
 
-        index = self.shared_training_params['stop']
         while index < p['coarse_stop']:
             self.coarse_classifier.fit(x_train, y_train_c,
                                        batch_size=p['batch_size'],
@@ -124,10 +151,10 @@ class HDCNN:
                                                         y_val_c),
                                        callbacks=[self.tbCallBack])
             index += p['step']
+            self.save_progress('coarse', index, sgd_coarse=sgd_coarse,
+                               sgd_fine=sgd_fine)
 
         # Fine training
-        sgd_fine = tf.keras.optimizers.SGD(
-            lr=0.001, decay=1e-6, momentum=0.9, nesterov=True)
         self.coarse_classifier.compile(optimizer=sgd_fine,
                                        loss='categorical_crossentropy',
                                        metrics=['accuracy'])
@@ -141,6 +168,8 @@ class HDCNN:
                                                         y_val_c),
                                        callbacks=[self.tbCallBack])
             index += p['step']
+            self.save_progress('coarse', index, sgd_coarse=sgd_coarse,
+                               sgd_fine=sgd_fine)
 
     def train_fine_classifiers(self, training_data, validation_data,
                                fine2coarse):
@@ -150,39 +179,46 @@ class HDCNN:
 
         p = self.fine_training_params
 
+        progress = self.restore_progress('fine')
         for i in range(self.n_coarse_categories):
+            if progress is not None and i < progress['classifier']:
+                continue
             logger.info(
                 f'Training fine classifier {i + 1}/{self.n_coarse_categories}')
             # Get all training data for the coarse category
-            ix = np.where([(y_train[:, j] == 1) for j in [
-                k for k, e in enumerate(fine2coarse[:, i])
-                if e != 0]])[1]
+            ix = np.where([(y_train[:, j] == 1)
+                           for j in fine2coarse.members[i]])[1]
             x_tix = tf.gather(x_train, ix)
             y_tix = tf.gather(y_train, ix)
 
             # Get all validation data for the coarse category
-            ix_v = np.where([(y_val[:, j] == 1) for j in [
-                k for k, e in enumerate(fine2coarse[:, i])
-                if e != 0]])[1]
+            ix_v = np.where([(y_val[:, j] == 1)
+                             for j in fine2coarse.members[i]])[1]
             x_vix = tf.gather(x_val, ix_v)
             y_vix = tf.gather(y_val, ix_v)
 
             sgd_coarse = tf.keras.optimizers.SGD(
                 lr=0.01, decay=1e-6, momentum=0.9, nesterov=True)
+            sgd_fine = tf.keras.optimizers.SGD(
+                lr=0.001, decay=1e-6, momentum=0.9, nesterov=True)
             self.fine_classifiers['models'][i].compile(
                 optimizer=sgd_coarse, loss='categorical_crossentropy',
                 metrics=['accuracy'])
 
             index = 0
+            if progress is not None and i == progress['classifier']:
+                self.restore_progress('fine', sgd_coarse=sgd_coarse,
+                                      sgd_fine=sgd_fine)
+                index = progress['epoch']
             while index < p['coarse_stop']:
                 self.fine_classifiers['models'][i].fit(
                     x_tix, y_tix, batch_size=p['batch_size'],
                     initial_epoch=index, epochs=index + p['step'],
                     validation_data=(x_vix, y_vix))
                 index += p['step']
+                self.save_progress('fine', index, classifier=i,
+                                   sgd_coarse=sgd_coarse, sgd_fine=sgd_fine)
 
-            sgd_fine = tf.keras.optimizers.SGD(
-                lr=0.001, decay=1e-6, momentum=0.9, nesterov=True)
             self.fine_classifiers['models'][i].compile(
                 optimizer=sgd_fine, loss='categorical_crossentropy',
                 metrics=['accuracy'])
@@ -193,12 +229,44 @@ class HDCNN:
                     initial_epoch=index, epochs=index + p['step'],
                     validation_data=(x_vix, y_vix))
                 index += p['step']
+                self.save_progress('fine', index, classifier=i,
+                                   sgd_coarse=sgd_coarse, sgd_fine=sgd_fine)
 
             yh_f = self.fine_classifiers['models'][i].predict(
                 x_val[ix_v], batch_size=p['batch_size'])
             logger.info('Fine Classifier ' + str(i) + ' Error: ' +
                         str(utils.get_error(y_val[ix_v], yh_f)))
 
+    def save_progress(self, stage, epoch, classifier=None, **optimizers):
+        progress = {'stage': stage, 'epoch': epoch}
+        if classifier is not None:
+            progress['classifier'] = classifier
+        self.checkpoint.save(progress, **self.checkpoint_objects(), **optimizers)
+
+    def restore_progress(self, stage, **optimizers):
+        """
+        Restores the resume checkpoint when training with --resume and it was
+        written in `stage` or a later one, and returns its progress. The
+        optimizers are only restored along when it was written in `stage`
+        """
+        if not self.args.resume:
+            return None
+        progress = self.checkpoint.progress()
+        if progress is None or STAGES.index(progress['stage']) < STAGES.index(stage):
+            return None
+        objects = self.checkpoint_objects()
+        if progress['stage'] == stage:
+            objects.update(optimizers)
+        self.checkpoint.restore(**objects)
+        return progress
+
+    def checkpoint_objects(self):
+        objects = {'full_classifier': self.full_classifier,
+                   'coarse_classifier': self.coarse_classifier}
+        for i, model in enumerate(self.fine_classifiers['models']):
+            objects[f'fine_classifier_{i}'] = model
+        return objects
+
     def sync_parameters(self):
         """
         Synchronize parameters from full, coarse and all fine classifiers
@@ -231,7 +299,7 @@ class HDCNN:
 
         yh_c = self.coarse_classifier.predict(
             x_test, batch_size=p['batch_size'])
-        y_c = np.dot(y_test, fine2coarse)
+        y_c = np.dot(y_test, fine2coarse.matrix)
 
         coarse_classifier_error = utils.get_error(y_c, yh_c)
         logger.info('Coarse Classifier Error: ' + str(coarse_classifier_error))
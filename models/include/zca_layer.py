@@ -0,0 +1,41 @@
+import numpy as np
+import tensorflow as tf
+
+
+class ZCAWhitening(tf.keras.layers.Layer):
+    """Fused ZCA whitening in front of a model, so it can be served raw images.
+
+    The mean and whitening matrix are stored as non-trainable weights and
+    saved with the model, so the config does not need to carry them. Loading
+    a saved model needs `custom_objects={'ZCAWhitening': ZCAWhitening}`.
+    """
+
+    def __init__(self, mean=None, matrix=None, **kwargs):
+        kwargs['trainable'] = False
+        super(ZCAWhitening, self).__init__(**kwargs)
+        self.initial_mean = mean
+        self.initial_matrix = matrix
+
+    def build(self, input_shape):
+        d = int(np.prod(input_shape[1:]))
+        mean = self.initial_mean
+        matrix = self.initial_matrix
+        self.mean = self.add_weight(
+            name='zca_mean', shape=(d,), trainable=False,
+            initializer='zeros' if mean is None else tf.constant_initializer(
+                np.asarray(mean, dtype=np.float32)))
+        self.matrix = self.add_weight(
+            name='zca_matrix', shape=(d, d), trainable=False,
+            initializer='identity' if matrix is None else
+            tf.constant_initializer(np.asarray(matrix, dtype=np.float32)))
+        super(ZCAWhitening, self).build(input_shape)
+
+    def call(self, x):
+        shape = tf.shape(x)
+        flat = tf.reshape(tf.cast(x, self.dtype), (shape[0], -1))
+        flat = tf.linalg.matmul(flat - self.mean, self.matrix)
+        return tf.reshape(flat, shape)
+
+    def get_config(self):
+        # The weights are restored after the layer is built from the identity
+        return super(ZCAWhitening, self).get_config()
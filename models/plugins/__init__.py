@@ -1 +1,6 @@
+from .checkpoint_writer import AsyncCheckpointWriter
+from .joint_step import JointTrainStep
 from .model_saver import ModelSaver as ModelSaverPlugin
+from .resume import ResumeCheckpoint
+from .throughput import ThroughputLogger
+from .training_state import TrainingState
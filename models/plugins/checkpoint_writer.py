@@ -0,0 +1,71 @@
+import atexit
+import logging
+import queue
+import threading
+import weakref
+
+import os
+import tensorflow as tf
+
+logger = logging.getLogger('CheckpointWriter')
+
+
+class AsyncCheckpointWriter:
+    def __init__(self, max_pending=2):
+        """
+        Writes Keras models to .h5 files on a background thread. The weights
+        are copied to host memory on the calling thread, which also clones the
+        model the first time it is saved, as Keras graph and naming state is
+        not thread-safe. The writer thread only sets the weights on the clone
+        and saves it to a temporary file renamed over the target once
+        complete, so a checkpoint on disk is never partially written. At most
+        `max_pending` checkpoints wait in the queue, further saves block until
+        one is written
+        """
+        self.queue = queue.Queue(max_pending)
+        # Clones die with the model they were made from
+        self.clones = weakref.WeakKeyDictionary()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def save(self, model, location):
+        self._raise()
+        clone = self.clones.get(model)
+        if clone is None:
+            clone = tf.keras.models.clone_model(model)
+            self.clones[model] = clone
+        self.queue.put((clone, model.get_weights(), location))
+        return location
+
+    def flush(self):
+        """Blocks until every queued checkpoint is on disk."""
+        self.queue.join()
+        self._raise()
+
+    def _run(self):
+        while True:
+            clone, weights, location = self.queue.get()
+            try:
+                self._write(clone, weights, location)
+            except Exception as e:
+                logger.exception(f'Failed to write {location}')
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _write(self, clone, weights, location):
+        clone.set_weights(weights)
+
+        # The temporary file keeps the extension that selects the h5 format
+        base, ext = os.path.splitext(location)
+        tmp = base + '.tmp' + ext
+        clone.save(tmp)
+        os.replace(tmp, location)
+        logger.debug(f'Wrote {location}')
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
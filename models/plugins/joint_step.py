@@ -0,0 +1,143 @@
+import logging
+
+import numpy as np
+import tensorflow as tf
+
+logger = logging.getLogger('JointTrainStep')
+
+
+class JointTrainStep:
+    def __init__(self, cc, fc, optimizer, loss_weights=(1., 1.), frozen=(),
+                 log_dir=None):
+        """
+        Compiled training loop of the coarse classifier `cc` (image ->
+        [features, coarse scores]) followed by the fine classifier `fc`. The
+        weighted sum of the fine and coarse losses is differentiated with
+        respect to the variables of the sub-models not named in `frozen`
+        ('cc', 'fc'). A frozen sub-model also runs in inference mode, so its
+        batch norm statistics are not updated and its dropout is off, without
+        flipping trainable flags and recompiling. The train and evaluation
+        steps are traced once, on their first batch, with a batch dimension of
+        any size. Epoch metrics are written to TensorBoard under `log_dir`, as
+        Keras fit does
+        """
+        self.cc = cc
+        self.fc = fc
+        self.optimizer = optimizer
+        self.loss_weights = loss_weights
+        self.trainable = {'cc': 'cc' not in frozen, 'fc': 'fc' not in frozen}
+        self.variables = []
+        if self.trainable['cc']:
+            self.variables += cc.trainable_variables
+        if self.trainable['fc']:
+            self.variables += fc.trainable_variables
+        self.loss_fn = tf.keras.losses.SparseCategoricalCrossentropy()
+        self.metrics = {
+            'loss': tf.keras.metrics.Mean(),
+            'fine_loss': tf.keras.metrics.Mean(),
+            'coarse_loss': tf.keras.metrics.Mean(),
+            'fine_accuracy': tf.keras.metrics.SparseCategoricalAccuracy(),
+            'coarse_accuracy': tf.keras.metrics.SparseCategoricalAccuracy(),
+        }
+        self.writers = None
+        if log_dir is not None:
+            self.writers = {
+                '': tf.summary.create_file_writer(log_dir + '/train'),
+                'val_': tf.summary.create_file_writer(log_dir + '/validation'),
+            }
+        self._train = None
+        self._test = None
+
+    def fit_epoch(self, train_data, validation_data, epoch, callbacks=()):
+        """Trains one epoch over batches of (x, (y, y_coarse)) and returns the
+        train and validation metrics.
+        """
+        for callback in callbacks:
+            callback.on_epoch_begin(epoch)
+        self._reset()
+        for i, (x, targets) in enumerate(train_data):
+            if self._train is None:
+                self._train = _compile(self._train_step, x, targets)
+            self._train(x, targets)
+            for callback in callbacks:
+                callback.on_train_batch_end(i)
+        if isinstance(train_data, tf.keras.utils.Sequence):
+            # Draws the next shuffle, as Keras fit does between epochs
+            train_data.on_epoch_end()
+        logs = self._results('')
+
+        self._reset()
+        for x, targets in validation_data:
+            if self._test is None:
+                self._test = _compile(self._test_step, x, targets)
+            self._test(x, targets)
+        logs.update(self._results('val_'))
+
+        for callback in callbacks:
+            callback.on_epoch_end(epoch, logs)
+        self._write(logs, epoch)
+        logger.info(f"Epoch {epoch + 1}: " + ', '.join(
+            f'{name}: {value:.4f}' for name, value in logs.items()))
+        return logs
+
+    def _losses(self, x, y, y_coarse, training):
+        features, coarse = self.cc(x, training=training and self.trainable['cc'])
+        fine = self.fc([features, coarse],
+                       training=training and self.trainable['fc'])
+        fine_loss = self.loss_fn(y, fine)
+        coarse_loss = self.loss_fn(y_coarse, coarse)
+        loss = (self.loss_weights[0] * fine_loss +
+                self.loss_weights[1] * coarse_loss)
+        regularization = self.cc.losses + self.fc.losses
+        if regularization:
+            loss += tf.add_n(regularization)
+        return loss, fine_loss, coarse_loss, fine, coarse
+
+    def _train_step(self, x, targets):
+        y, y_coarse = targets
+        with tf.GradientTape() as tape:
+            losses = self._losses(x, y, y_coarse, True)
+        gradients = tape.gradient(losses[0], self.variables)
+        self.optimizer.apply_gradients(zip(gradients, self.variables))
+        self._update(losses, y, y_coarse)
+
+    def _test_step(self, x, targets):
+        y, y_coarse = targets
+        self._update(self._losses(x, y, y_coarse, False), y, y_coarse)
+
+    def _update(self, losses, y, y_coarse):
+        loss, fine_loss, coarse_loss, fine, coarse = losses
+        self.metrics['loss'].update_state(loss)
+        self.metrics['fine_loss'].update_state(fine_loss)
+        self.metrics['coarse_loss'].update_state(coarse_loss)
+        self.metrics['fine_accuracy'].update_state(y, fine)
+        self.metrics['coarse_accuracy'].update_state(y_coarse, coarse)
+
+    def _reset(self):
+        for metric in self.metrics.values():
+            metric.reset_states()
+
+    def _results(self, prefix):
+        return {prefix + name: float(metric.result().numpy())
+                for name, metric in self.metrics.items()}
+
+    def _write(self, logs, epoch):
+        if self.writers is None:
+            return
+        for prefix, writer in self.writers.items():
+            with writer.as_default():
+                for name in self.metrics:
+                    tf.summary.scalar('epoch_' + name, logs[prefix + name],
+                                      step=epoch)
+
+
+def _compile(step, x, targets):
+    # The signature takes the dtypes of the first batch and any batch size, so
+    # the smaller last batch of an epoch does not trigger a retrace
+    def spec(t):
+        return tf.TensorSpec([None] + list(np.shape(t))[1:],
+                             tf.as_dtype(t.dtype))
+
+    signature = [tf.nest.map_structure(spec, x),
+                 tf.nest.map_structure(spec, targets)]
+    return tf.function(step, input_signature=signature)
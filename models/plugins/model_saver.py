@@ -7,14 +7,22 @@ logger = logging.getLogger('ModelSaver')
 
 
 class ModelSaver:
+    # Set to an AsyncCheckpointWriter to write the models in the background
+    checkpoint_writer = None
+
     def save_model(self, filename, model):
         logger.debug(f'Saving model to {filename}')
         filepath = os.path.dirname(filename)
         if not os.path.exists(filepath):
             os.makedirs(filepath)
-        tf.keras.models.save_model(model, filename)
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.save(model, filename)
+        else:
+            tf.keras.models.save_model(model, filename)
 
     def load_model(self, filename):
         logger.debug(f'Loading model from {filename}')
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.flush()
         model = tf.keras.models.load_model(filename)
         return model
@@ -0,0 +1,75 @@
+import glob
+import json
+import logging
+
+import numpy as np
+import os
+import tensorflow as tf
+
+logger = logging.getLogger('ResumeCheckpoint')
+
+STATE = 'state.json'
+
+
+class ResumeCheckpoint:
+    def __init__(self, directory):
+        """
+        Checkpoint an interrupted training resumes from. The models and the
+        optimizer, with its slots, iteration count and learning rate, are
+        written with tf.train.Checkpoint, extra arrays in a .npz file next to
+        it and the progress of the training loop in a json file. The json
+        file is replaced last, so it always points to a complete checkpoint
+        """
+        self.directory = directory
+
+    def save(self, progress, arrays=None, **objects):
+        os.makedirs(self.directory, exist_ok=True)
+        previous = self._read()
+        count = previous['count'] + 1 if previous is not None else 0
+        prefix = os.path.join(self.directory, f'ckpt-{count}')
+        tf.train.Checkpoint(**objects).write(prefix)
+        if arrays is not None:
+            np.savez(prefix + '.npz', **arrays)
+
+        path = os.path.join(self.directory, STATE)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'count': count, 'arrays': arrays is not None,
+                       'progress': progress}, f, indent=2)
+        os.replace(tmp, path)
+
+        if previous is not None:
+            for filename in glob.glob(os.path.join(
+                    self.directory, f"ckpt-{previous['count']}.*")):
+                os.remove(filename)
+        logger.debug(f'Checkpoint {prefix}: {progress}')
+
+    def restore(self, **objects):
+        """Restores `objects` and returns the progress and the extra arrays of
+        the last checkpoint, or None when there is none.
+        """
+        state = self._read()
+        if state is None:
+            return None
+        prefix = os.path.join(self.directory, f"ckpt-{state['count']}")
+        tf.train.Checkpoint(**objects).read(prefix).expect_partial()
+        arrays = None
+        if state['arrays']:
+            with np.load(prefix + '.npz') as f:
+                arrays = dict(f)
+        logger.info(f"Resuming from {prefix}: {state['progress']}")
+        return state['progress'], arrays
+
+    def progress(self):
+        """Returns the progress of the last checkpoint without restoring it,
+        or None when there is none.
+        """
+        state = self._read()
+        return state['progress'] if state is not None else None
+
+    def _read(self):
+        path = os.path.join(self.directory, STATE)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
@@ -0,0 +1,42 @@
+import logging
+import resource
+import time
+
+import tensorflow as tf
+
+logger = logging.getLogger('Throughput')
+
+
+class ThroughputLogger(tf.keras.callbacks.Callback):
+    def __init__(self, batch_size, memory_bound=None):
+        """
+        Logs the training throughput of every epoch with the peak resident
+        memory of the process and, when training out of core, the bound on
+        the memory held by the input pipeline
+        """
+        super(ThroughputLogger, self).__init__()
+        self.batch_size = batch_size
+        self.memory_bound = memory_bound
+        self.start = None
+        self.batches = 0
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.start = time.time()
+        self.batches = 0
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.batches += 1
+
+    def on_epoch_end(self, epoch, logs=None):
+        elapsed = time.time() - self.start
+        images_per_second = self.batches * self.batch_size / elapsed
+        # ru_maxrss is in kilobytes on Linux
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        message = (f"Epoch {epoch + 1}: {images_per_second:.1f} images/s, "
+                   f"peak RSS {peak_rss:.0f} MB")
+        if self.memory_bound is not None:
+            message += (f", input pipeline bound "
+                        f"{self.memory_bound / 2 ** 20:.0f} MB")
+        logger.info(message)
+        if logs is not None:
+            logs['images_per_second'] = images_per_second
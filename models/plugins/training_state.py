@@ -0,0 +1,140 @@
+import logging
+
+from .resume import ResumeCheckpoint
+
+logger = logging.getLogger('TrainingState')
+
+
+class TrainingState:
+    def __init__(self, models, save_best, save_current=(), persist_every=1,
+                 optimizer=None, directory=None, flush=None):
+        """
+        Best weights of the models trained in a stage, kept as an in-memory
+        snapshot next to the current weights of the live models. Restoring the
+        best weights does not touch the disk, and both are written with the
+        `save_best` and `save_current` functions only every `persist_every`
+        epochs and when the stage finishes.
+
+        With a `directory`, the same cadence writes a resume checkpoint of the
+        models, the `optimizer`, the best weights and the loop progress (next
+        epoch, best validation loss, patience count and learning rate). `flush`
+        waits for the saves still in flight before a stage is marked finished
+        """
+        self.models = models
+        self.save_best = save_best
+        self.save_current = save_current
+        self.persist_every = persist_every
+        self.optimizer = optimizer
+        self.checkpoint = ResumeCheckpoint(directory) if directory else None
+        self.flush = flush
+        self.best = None
+        self.best_persisted = True
+        self.epochs = 0
+
+        # Progress of the training loop
+        self.epoch = 0
+        self.best_loss = float('inf')
+        self.patience_count = 0
+        self.finished = False
+
+    def snapshot(self):
+        return [m.get_weights() for m in self.models]
+
+    def restore(self, weights):
+        for m, w in zip(self.models, weights):
+            m.set_weights(w)
+
+    def improved(self):
+        """Takes the current weights as the best ones."""
+        self.best = self.snapshot()
+        self.best_persisted = False
+
+    def restore_best(self):
+        if self.best is not None:
+            logger.debug('Restoring the best weights')
+            self.restore(self.best)
+
+    def end_epoch(self, epoch, best_loss, patience_count):
+        """Records the progress of the loop, `epoch` being the next one."""
+        self.epoch = epoch
+        self.best_loss = best_loss
+        self.patience_count = patience_count
+        self.epochs += 1
+        if self.epochs % self.persist_every == 0:
+            self.persist()
+
+    def persist(self):
+        for save in self.save_current:
+            save()
+        if not self.best_persisted:
+            # The save functions write the live models, so the best weights
+            # are swapped in for the time of the write
+            current = self.snapshot()
+            self.restore(self.best)
+            self._save_best()
+            self.restore(current)
+        self._save_checkpoint()
+
+    def finish(self):
+        """Writes the last weights, then leaves the models with the best
+        weights and writes them if they were not yet.
+        """
+        for save in self.save_current:
+            save()
+        self.restore_best()
+        if not self.best_persisted:
+            self._save_best()
+        if self.checkpoint is not None:
+            if self.flush is not None:
+                self.flush()
+            self.finished = True
+            self._save_checkpoint()
+
+    def resume(self):
+        """Restores the last checkpoint, returns whether there was one."""
+        if self.checkpoint is None:
+            return False
+        restored = self.checkpoint.restore(**self._objects())
+        if restored is None:
+            return False
+        progress, arrays = restored
+        self.epoch = progress['epoch']
+        self.best_loss = progress['best_loss']
+        self.patience_count = progress['patience_count']
+        self.finished = progress['finished']
+        if self.optimizer is not None:
+            self.optimizer.learning_rate.assign(progress['lr'])
+        if arrays is not None:
+            self.best = [[arrays[f'{i}_{j}'] for j in range(len(m.weights))]
+                         for i, m in enumerate(self.models)]
+            # The best weights on disk may be older than the checkpoint
+            self.best_persisted = False
+        return True
+
+    def _save_best(self):
+        for save in self.save_best:
+            save()
+        self.best_persisted = True
+
+    def _save_checkpoint(self):
+        if self.checkpoint is None:
+            return
+        progress = {
+            'epoch': self.epoch,
+            'best_loss': self.best_loss,
+            'patience_count': self.patience_count,
+            'finished': self.finished,
+        }
+        if self.optimizer is not None:
+            progress['lr'] = float(self.optimizer.learning_rate.numpy())
+        arrays = None
+        if self.best is not None:
+            arrays = {f'{i}_{j}': w for i, weights in enumerate(self.best)
+                      for j, w in enumerate(weights)}
+        self.checkpoint.save(progress, arrays, **self._objects())
+
+    def _objects(self):
+        objects = {f'model_{i}': m for i, m in enumerate(self.models)}
+        if self.optimizer is not None:
+            objects['optimizer'] = self.optimizer
+        return objects
@@ -0,0 +1,581 @@
+import json
+import logging
+from datetime import datetime
+
+import numpy as np
+import tensorflow as tf
+
+import utils
+from datasets.augment import ONLINE_AUGMENTATION
+from datasets.pipeline import OUT_OF_CORE_CHUNK_SIZE, build_dataset, memory_bound
+from datasets.sampler import IndexSampler
+from models.plugins import (AsyncCheckpointWriter, JointTrainStep,
+                            ThroughputLogger, TrainingState)
+from models.include.zca_layer import ZCAWhitening
+
+
+class HierarchicalTrainer:
+    # Names of the .h5 files are built from these, e.g. <prefix>_cc.h5
+    file_prefix = None
+    tmp_suffix = 'tmp'
+    # Custom layers of the fc model, needed to load it
+    custom_objects = None
+    logger_name = 'Trainer'
+
+    def __init__(self, n_fine_categories, n_coarse_categories, input_shape,
+                 logs_directory=None, model_directory=None, args=None,
+                 input_transform=None):
+        """
+        Training engine shared by the hierarchical models. It holds the coarse,
+        fine and joint training stages with their early stopping, LR
+        reduction and checkpointing, the predictions and the model files.
+        Subclasses only provide `build_cc_fc`, which returns the coarse
+        classifier (image -> [features, coarse scores]) and the fine
+        classifier ([features, coarse scores] -> fine scores)
+        """
+        self.logger = logging.getLogger(self.logger_name)
+        self.model_directory = model_directory
+        self.args = args
+        self.input_transform = input_transform
+        self.n_fine_categories = n_fine_categories
+        self.n_coarse_categories = n_coarse_categories
+        self.input_shape = input_shape
+
+        self.cc, self.fc, self.full_model = None, None, None
+        self.attention = None
+        self.checkpoint_writer = AsyncCheckpointWriter()
+
+        current_time = datetime.now().strftime("%Y%m%d-%H%M%S")
+
+        self.tbCallback_coarse = tf.keras.callbacks.TensorBoard(
+            log_dir=logs_directory + '/' + current_time + '/coarse',
+            update_freq='epoch')  # How often to write logs (default: once per epoch)
+        self.tbCallback_fine = tf.keras.callbacks.TensorBoard(
+            log_dir=logs_directory + '/' + current_time + '/fine',
+            update_freq='epoch')  # How often to write logs (default: once per epoch)
+        self.tbCallback_full = tf.keras.callbacks.TensorBoard(
+            log_dir=logs_directory + '/' + current_time + '/full',
+            update_freq='epoch')  # How often to write logs (default: once per epoch)
+
+
+        self.training_params = {
+            'batch_size': 64,
+            'initial_epoch': 0,
+            'lr_coarse': 1e-3,
+            'lr_fine': 1e-3,
+            'lr_full': 1e-5,
+            'step': 1,  # Save weights every this amount of epochs
+            'step_full': 1,
+            'fine_loss_weight': 1.,
+            'coarse_loss_weight': 1.,
+            'frozen_full': [],  # Sub-models ('cc', 'fc') not updated in the joint stage
+            'persist_every': 5,  # Write the weights to disk every this amount of epochs
+            'stop': 10000,
+            'patience': 5,
+            'reduce_lr_after_patience_counts': 1,
+            "validation_loss_threshold": 0,
+            'lr_reduction_factor': 0.1,
+            'shuffle_buffer': 10000,
+            'augment': None,
+            'chunk_size': None
+        }
+
+        if self.args.debug_mode:
+            self.training_params['step'] = 1
+            self.training_params['stop'] = 1
+
+        if self.args.online_augmentation:
+            self.training_params['augment'] = ONLINE_AUGMENTATION
+        if self.args.out_of_core:
+            self.training_params['chunk_size'] = OUT_OF_CORE_CHUNK_SIZE
+
+        self.prediction_params = {
+            'batch_size': 64
+        }
+
+    def save_best_cc_model(self):
+        self.logger.info(f"Saving best cc model")
+        loc = self.model_directory + f"/{self.file_prefix}_cc.h5"
+        self.checkpoint_writer.save(self.cc, loc)
+        return loc
+
+    def save_best_fc_model(self):
+        self.logger.info(f"Saving best fc model")
+        loc = self.model_directory + f"/{self.file_prefix}_fc.h5"
+        self.checkpoint_writer.save(self.fc, loc)
+        return loc
+
+    def save_best_cc_both_model(self):
+        self.logger.info(f"Saving best cc both model")
+        loc = self.model_directory + f"/{self.file_prefix}_cc_both.h5"
+        self.checkpoint_writer.save(self.cc, loc)
+        return loc
+
+    def save_best_fc_both_model(self):
+        self.logger.info(f"Saving best fc both model")
+        loc = self.model_directory + f"/{self.file_prefix}_fc_both.h5"
+        self.checkpoint_writer.save(self.fc, loc)
+        return loc
+
+    def save_cc_model(self):
+        self.logger.info(f"Saving cc model")
+        loc = self.model_directory + f"/{self.file_prefix}_cc_{self.tmp_suffix}.h5"
+        self.checkpoint_writer.save(self.cc, loc)
+        return loc
+
+    def save_fc_model(self):
+        self.logger.info(f"Saving fc model")
+        loc = self.model_directory + f"/{self.file_prefix}_fc_{self.tmp_suffix}.h5"
+        self.checkpoint_writer.save(self.fc, loc)
+        return loc
+
+    def load_best_cc_model(self):
+        self.logger.info(f"Loading best cc model")
+        self.load_cc_model(self.model_directory + f"/{self.file_prefix}_cc.h5")
+
+    def load_best_fc_model(self):
+        self.logger.info(f"Loading best fc model")
+        self.load_fc_model(self.model_directory + f"/{self.file_prefix}_fc.h5")
+
+    def load_best_cc_both_model(self):
+        self.logger.info(f"Loading best cc both model")
+        self.load_cc_model(self.model_directory + f"/{self.file_prefix}_cc_both.h5")
+
+    def load_best_fc_both_model(self):
+        self.logger.info(f"Loading best fc both model")
+        self.load_fc_model(self.model_directory + f"/{self.file_prefix}_fc_both.h5")
+
+    def load_cc_model(self, location):
+        self.logger.info(f"Loading cc model")
+        self.checkpoint_writer.flush()
+        self.cc = tf.keras.models.load_model(location)
+
+    def load_fc_model(self, location):
+        self.logger.info(f"Loading fc model")
+        self.checkpoint_writer.flush()
+        self.fc = tf.keras.models.load_model(location,
+                                             custom_objects=self.custom_objects)
+
+    def train_coarse(self, training_data, validation_data, fine2coarse):
+        x_train, y_train = training_data
+        yc_train = fine2coarse.coarse(y_train)
+
+        x_val, y_val = validation_data
+        yc_val = fine2coarse.coarse(y_val)
+
+        del y_train, y_val
+
+        p = self.training_params
+        val_thresh = p["validation_loss_threshold"]
+
+        self.logger.debug(f"Creating coarse classifier with shared layers")
+        tf.keras.backend.clear_session()
+        self.cc, _ = self.build_cc_fc(verbose=False)
+        self.fc = None
+        optim = tf.keras.optimizers.SGD(lr=p['lr_coarse'], nesterov=True, momentum=0.5)
+
+        # Built and compiled once, the weights stay in memory between epochs
+        cc = tf.keras.Model(inputs=self.cc.inputs, outputs=self.cc.outputs[1])
+        cc.compile(optimizer=optim,
+                   loss='sparse_categorical_crossentropy',
+                   metrics=['accuracy'])
+        state = TrainingState([self.cc], [self.save_best_cc_model],
+                              [self.save_cc_model], p['persist_every'], optim,
+                              self.model_directory + '/resume/coarse',
+                              self.checkpoint_writer.flush)
+
+        self.logger.info('Start Coarse Classification Training')
+
+        if self.args.pipeline:
+            val_ds = build_dataset(x_val, yc_val, p['batch_size'],
+                                   transform=self.input_transform)
+            throughput = ThroughputLogger(
+                p['batch_size'],
+                memory_bound(x_train, p['batch_size'], p['shuffle_buffer'],
+                             p['chunk_size']))
+
+        index = p['initial_epoch']
+
+        prev_val_loss = float('inf')
+        counts_patience = 0
+        patience = p["patience"]
+        if self.args.resume and state.resume():
+            if state.finished:
+                self.logger.info('Coarse classifier already trained')
+                return
+            index, prev_val_loss, counts_patience = (
+                state.epoch, state.best_loss, state.patience_count)
+        while index < p['stop']:
+            if self.args.pipeline:
+                train_ds = build_dataset(x_train, yc_train, p['batch_size'],
+                                         shuffle=True, seed=index,
+                                         buffer_size=p['shuffle_buffer'],
+                                         augment=p['augment'],
+                                         chunk_size=p['chunk_size'],
+                                         transform=self.input_transform)
+                cc_fit = cc.fit(train_ds,
+                                initial_epoch=index,
+                                epochs=index + p["step"],
+                                validation_data=val_ds,
+                                callbacks=[self.tbCallback_coarse, throughput])
+            else:
+                train_seq = IndexSampler(x_train, yc_train, p['batch_size'],
+                                         seed=index)
+                cc_fit = cc.fit(train_seq,
+                                initial_epoch=index,
+                                epochs=index + p["step"],
+                                validation_data=(x_val, yc_val),
+                                callbacks=[self.tbCallback_coarse])
+            val_loss = cc_fit.history["val_loss"][-1]
+            if prev_val_loss - val_loss < val_thresh:
+                counts_patience += 1
+                self.logger.info(f"Counts to early stopping: {counts_patience}/{p['patience']}")
+                if counts_patience >= patience:
+                    break
+                elif counts_patience % p["reduce_lr_after_patience_counts"] == 0:
+                    new_val = optim.learning_rate * p["lr_reduction_factor"]
+                    self.logger.info(f"LR is now: {new_val.numpy()}")
+                    optim.learning_rate.assign(new_val)
+                    state.restore_best()
+            else:
+                counts_patience = 0
+                prev_val_loss = val_loss
+                state.improved()
+            index += p["step"]
+            state.end_epoch(index, prev_val_loss, counts_patience)
+        state.finish()
+
+    def train_fine(self, training_data, validation_data, fine2coarse):
+        x_train, y_train = training_data
+        # The fine classifier is fed the coarse class as a one-hot input
+        yc_train = tf.one_hot(fine2coarse.coarse(y_train),
+                              self.n_coarse_categories)
+        x_val, y_val = validation_data
+        yc_val = tf.one_hot(fine2coarse.coarse(y_val),
+                            self.n_coarse_categories)
+
+        p = self.training_params
+        val_thresh = p["validation_loss_threshold"]
+
+        tf.keras.backend.clear_session()
+        _, self.fc = self.build_cc_fc(verbose=False)
+        self.load_best_cc_model()
+        self.build_fine_model()
+
+        for l in self.cc.layers:
+            l.trainable = False
+        for l in self.fc.layers:
+            l.trainable = True
+
+        optim = tf.keras.optimizers.SGD(lr=p['lr_fine'], nesterov=True, momentum=0.5)
+        self.full_model.compile(optimizer=optim,
+                                loss='sparse_categorical_crossentropy',
+                                metrics=['accuracy'])
+        state = TrainingState([self.fc], [self.save_best_fc_model],
+                              [self.save_fc_model], p['persist_every'], optim,
+                              self.model_directory + '/resume/fine',
+                              self.checkpoint_writer.flush)
+
+        self.logger.info('Start Fine Classification Training')
+
+        if self.args.pipeline:
+            val_ds = build_dataset((x_val, yc_val), y_val, p['batch_size'],
+                                   transform=self.input_transform)
+            throughput = ThroughputLogger(
+                p['batch_size'],
+                memory_bound(x_train, p['batch_size'], p['shuffle_buffer'],
+                             p['chunk_size']))
+
+        index = p['initial_epoch']
+
+        prev_val_loss = float('inf')
+        counts_patience = 0
+        patience = p["patience"]
+
+        if self.args.resume and state.resume():
+            if state.finished:
+                self.logger.info('Fine classifier already trained')
+                return
+            index, prev_val_loss, counts_patience = (
+                state.epoch, state.best_loss, state.patience_count)
+        while index < p['stop']:
+            if self.args.pipeline:
+                train_ds = build_dataset((x_train, yc_train), y_train, p['batch_size'],
+                                         shuffle=True, seed=index,
+                                         buffer_size=p['shuffle_buffer'],
+                                         augment=p['augment'],
+                                         chunk_size=p['chunk_size'],
+                                         transform=self.input_transform)
+                fc_fit = self.full_model.fit(train_ds,
+                                             initial_epoch=index,
+                                             epochs=index + p["step"],
+                                             validation_data=val_ds,
+                                             callbacks=[self.tbCallback_fine, throughput])
+            else:
+                train_seq = IndexSampler([x_train, yc_train], y_train,
+                                         p['batch_size'], seed=index)
+                fc_fit = self.full_model.fit(train_seq,
+                                             initial_epoch=index,
+                                             epochs=index + p["step"],
+                                             validation_data=([x_val, yc_val], y_val),
+                                             callbacks=[self.tbCallback_fine])
+            val_loss = fc_fit.history["val_loss"][-1]
+            if prev_val_loss - val_loss < val_thresh:
+                counts_patience += 1
+                self.logger.info(f"Counts to early stopping: {counts_patience}/{p['patience']}")
+                if counts_patience >= patience:
+                    break
+                elif counts_patience % p["reduce_lr_after_patience_counts"] == 0:
+                    new_val = optim.learning_rate * p["lr_reduction_factor"]
+                    self.logger.info(f"LR is now: {new_val.numpy()}")
+                    optim.learning_rate.assign(new_val)
+                    state.restore_best()
+            else:
+                counts_patience = 0
+                prev_val_loss = val_loss
+                state.improved()
+            index += p["step"]
+            state.end_epoch(index, prev_val_loss, counts_patience)
+        state.finish()
+
+    def train_both(self, training_data, validation_data, fine2coarse):
+        x_train, y_train = training_data
+        x_val, y_val = validation_data
+        yc_train = fine2coarse.coarse(y_train)
+        yc_val = fine2coarse.coarse(y_val)
+
+        p = self.training_params
+        val_thresh = p["validation_loss_threshold"]
+
+        self.logger.info('Start Full Classification training')
+
+        index = p['initial_epoch']
+
+        tf.keras.backend.clear_session()
+        self.load_best_cc_model()
+        self.load_best_fc_model()
+        self.build_full_model()
+
+        optim = tf.keras.optimizers.SGD(lr=p['lr_full'], nesterov=True, momentum=0.5)
+        joint_step = JointTrainStep(self.cc, self.fc, optim,
+                                    (p['fine_loss_weight'], p['coarse_loss_weight']),
+                                    frozen=p['frozen_full'],
+                                    log_dir=self.tbCallback_full.log_dir)
+        state = TrainingState([self.cc, self.fc],
+                              [self.save_best_cc_both_model,
+                               self.save_best_fc_both_model],
+                              [self.save_cc_model, self.save_fc_model],
+                              p['persist_every'], optim,
+                              self.model_directory + '/resume/both',
+                              self.checkpoint_writer.flush)
+
+        val_ds = build_dataset(x_val, (y_val, yc_val), p['batch_size'],
+                               transform=self.input_transform)
+        callbacks = []
+        if self.args.pipeline:
+            callbacks.append(ThroughputLogger(
+                p['batch_size'],
+                memory_bound(x_train, p['batch_size'], p['shuffle_buffer'],
+                             p['chunk_size'])))
+
+        prev_val_loss = float('inf')
+        counts_patience = 0
+        patience = p["patience"]
+        if self.args.resume and state.resume():
+            if state.finished:
+                self.logger.info('Full classifier already trained')
+                return
+            index, prev_val_loss, counts_patience = (
+                state.epoch, state.best_loss, state.patience_count)
+        while index < p['stop']:
+            if self.args.pipeline:
+                train_data = build_dataset(x_train, (y_train, yc_train), p['batch_size'],
+                                           shuffle=True, seed=index,
+                                           buffer_size=p['shuffle_buffer'],
+                                           augment=p['augment'],
+                                           chunk_size=p['chunk_size'],
+                                           transform=self.input_transform)
+            else:
+                train_data = IndexSampler(x_train, (y_train, yc_train),
+                                          p['batch_size'], seed=index)
+            for epoch in range(index, index + p["step_full"]):
+                logs = joint_step.fit_epoch(train_data, val_ds, epoch, callbacks)
+            val_loss = logs["val_loss"]
+            if prev_val_loss - val_loss < val_thresh:
+                counts_patience += 1
+                self.logger.info(f"Counts to early stopping: {counts_patience}/{p['patience']}")
+                if counts_patience >= patience:
+                    break
+                elif counts_patience % p["reduce_lr_after_patience_counts"] == 0:
+                    new_val = optim.learning_rate * p["lr_reduction_factor"]
+                    self.logger.info(f"LR is now: {new_val.numpy()}")
+                    optim.learning_rate.assign(new_val)
+                    state.restore_best()
+            else:
+                counts_patience = 0
+                prev_val_loss = val_loss
+                state.improved()
+            index += p["step_full"]
+            state.end_epoch(index, prev_val_loss, counts_patience)
+        state.finish()
+
+    def predict_coarse(self, testing_data, fine2coarse, results_file):
+        x_test, y_test = testing_data
+        yc_test = fine2coarse.coarse(y_test)
+
+        p = self.prediction_params
+
+        yc_pred = self.cc.predict(x_test, batch_size=p['batch_size'])
+
+        coarse_classifier_error = utils.get_error(yc_test, yc_pred)
+
+        self.logger.info('Coarse Classifier Error: ' + str(coarse_classifier_error))
+        results_dict = {'Coarse Classifier Error': coarse_classifier_error}
+        self.write_results(results_file, results_dict=results_dict)
+
+        tf.keras.backend.clear_session()
+        return yc_pred
+
+    def predict_fine(self, testing_data, results_file):
+        x_test_feat, yc_pred, y_test = testing_data
+
+        p = self.prediction_params
+
+        yh_s = self.fc.predict([x_test_feat, yc_pred], batch_size=p['batch_size'])
+
+        single_classifier_error = utils.get_error(y_test, yh_s)
+        self.logger.info('Single Classifier Error: ' + str(single_classifier_error))
+
+        results_dict = {'Single Classifier Error': single_classifier_error}
+        self.write_results(results_file, results_dict=results_dict)
+
+        tf.keras.backend.clear_session()
+        return yh_s
+
+    def predict_full(self, testing_data, fine2coarse, results_file, whitening=None):
+        x_test, y_test = testing_data
+        if whitening is not None:
+            x_test = whitening(x_test)
+        yc_test = fine2coarse.coarse(y_test)
+
+        p = self.prediction_params
+
+        self.load_best_cc_both_model()
+        self.load_best_fc_both_model()
+        self.build_full_model()
+
+        [yh_s, ych_s] = self.full_model.predict(x_test, batch_size=p['batch_size'])
+
+        fine_classification_error = utils.get_error(y_test, yh_s)
+        self.logger.info('Fine Classifier Error: ' + str(fine_classification_error))
+
+        coarse_classification_error = utils.get_error(yc_test, ych_s)
+        self.logger.info('Coarse Classifier Error: ' + str(coarse_classification_error))
+
+        mismatch = self.find_mismatch_error(yh_s, ych_s, fine2coarse)
+        self.logger.info('Mismatch Error: ' + str(mismatch))
+
+        results_dict = {'Fine Classifier Error': fine_classification_error,
+                        'Coarse Classifier Error': coarse_classification_error,
+                        'Mismatch Error': mismatch}
+
+        self.write_results(results_file, results_dict=results_dict)
+
+        np.save(self.model_directory + "/fine_predictions.npy", yh_s)
+        np.save(self.model_directory + "/coarse_predictions.npy", ych_s)
+        np.save(self.model_directory + "/fine_labels.npy", y_test)
+        np.save(self.model_directory + "/coarse_labels.npy", yc_test)
+
+        tf.keras.backend.clear_session()
+        return yh_s, ych_s
+
+    def predict_full_using_best_non_both(self, testing_data, fine2coarse, results_file):
+        x_test, y_test = testing_data
+        yc_test = fine2coarse.coarse(y_test)
+
+        p = self.prediction_params
+
+        self.load_best_cc_model()
+        self.load_best_fc_model()
+        self.build_full_model()
+
+        [yh_s, ych_s] = self.full_model.predict(x_test, batch_size=p['batch_size'])
+
+        fine_classification_error = utils.get_error(y_test, yh_s)
+        self.logger.info('Fine Classifier Error: ' + str(fine_classification_error))
+
+        coarse_classification_error = utils.get_error(yc_test, ych_s)
+        self.logger.info('Coarse Classifier Error: ' + str(coarse_classification_error))
+
+        mismatch = self.find_mismatch_error(yh_s, ych_s, fine2coarse)
+        self.logger.info('Mismatch Error: ' + str(mismatch))
+
+        results_dict = {'Fine Classifier Error': fine_classification_error,
+                        'Coarse Classifier Error': coarse_classification_error,
+                        'Mismatch Error': mismatch}
+
+        self.write_results(results_file, results_dict=results_dict)
+
+        np.save(self.model_directory + "/fine_predictions.npy", yh_s)
+        np.save(self.model_directory + "/coarse_predictions.npy", ych_s)
+        np.save(self.model_directory + "/fine_labels.npy", y_test)
+        np.save(self.model_directory + "/coarse_labels.npy", yc_test)
+
+        tf.keras.backend.clear_session()
+        return yh_s, ych_s
+
+    def export_serving_model(self, whitening, location):
+        """
+        Saves the best full model behind a fused ZCA whitening layer, so it can
+        be served raw images without the training set. Load it with
+        ZCAWhitening and the model's `custom_objects` in the custom objects
+        """
+        self.logger.info(f"Exporting serving model to {location}")
+        self.load_best_cc_both_model()
+        self.load_best_fc_both_model()
+        self.build_full_model()
+
+        inp = tf.keras.Input(shape=self.input_shape)
+        net = ZCAWhitening(whitening.mean, whitening.matrix)(inp)
+        fine, coarse = self.full_model(net)
+        serving_model = tf.keras.Model(inputs=inp, outputs=[fine, coarse])
+        serving_model.save(location)
+        return location
+
+    def find_mismatch_error(self, fine_pred, coarse_pred, fine2coarse):
+        # Convert fine pred to coarse pred
+        coarse_pred_from_fine = fine2coarse.coarse_scores(fine_pred)
+        n_pred = coarse_pred.shape[0]
+        # Convert probabilities to labels
+        c_l = np.argmax(coarse_pred, axis=1)
+        cf_l = np.argmax(coarse_pred_from_fine, axis=1)
+        # Find mismatches
+        diff = np.where(c_l != cf_l)[0]
+        mis = diff.shape[0] / n_pred
+        return mis
+
+    def write_results(self, results_file, results_dict):
+        for a, b in results_dict.items():
+            # Ensure that results_dict is made by numbers and lists only
+            if type(b) is np.ndarray:
+                results_dict[a] = b.tolist()
+        json.dump(results_dict, open(results_file, 'w'))
+
+    def build_cc_fc(self, verbose=True):
+        raise NotImplementedError
+
+    def build_full_model(self):
+        inp = tf.keras.Input(shape=self.cc.input.shape[1:])
+        cc_feat, cc_lab = self.cc(inp)
+
+        fc_lab = self.fc([cc_feat, cc_lab])
+        self.full_model = tf.keras.Model(inputs=inp, outputs=[fc_lab, cc_lab])
+
+    def build_fine_model(self):
+        inp2 = tf.keras.Input(shape=self.cc.outputs[1].shape[1:])
+        inp = tf.keras.Input(shape=self.cc.input.shape[1:])
+        s = self.cc.outputs[0].shape
+
+        cc_feat, _ = self.cc(inp)
+        fc_lab = self.fc([cc_feat, inp2])
+        self.full_model = tf.keras.Model(inputs=[inp, inp2], outputs=fc_lab)
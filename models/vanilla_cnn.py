@@ -6,24 +6,30 @@ import numpy as np
 import tensorflow as tf
 
 import utils
-from datasets.preprocess import shuffle_data
+from datasets.augment import ONLINE_AUGMENTATION
+from datasets.pipeline import OUT_OF_CORE_CHUNK_SIZE, build_dataset, memory_bound
+from datasets.sampler import IndexSampler
+from models.plugins import AsyncCheckpointWriter, ThroughputLogger, TrainingState
 
 logger = logging.getLogger('VANILLA-CNN')
 
 
 class VanillaCNN:
     def __init__(self, n_fine_categories, n_coarse_categories, input_shape,
-                 logs_directory=None, model_directory=None, args=None):
+                 logs_directory=None, model_directory=None, args=None,
+                 input_transform=None):
         """
         Vanilla CNN
         """
         self.model_directory = model_directory
         self.args = args
+        self.input_transform = input_transform
         self.n_fine_categories = n_fine_categories
         self.n_coarse_categories = n_coarse_categories
         self.input_shape = input_shape
 
         self.full_model = None
+        self.checkpoint_writer = AsyncCheckpointWriter()
         self.attention_units = 128
 
         current_time = datetime.now().strftime("%Y%m%d-%H%M%S")
@@ -38,17 +44,26 @@ class VanillaCNN:
             'initial_epoch': 0,
             'lr': 1e-2,
             'step': 1,  # Save weights every this amount of epochs
+            'persist_every': 5,  # Write the weights to disk every this amount of epochs
             'stop': 10000,
             'patience': 5,
             'reduce_lr_after_patience_counts': 1,
             "validation_loss_threshold": 0,
-            'lr_reduction_factor': 0.1
+            'lr_reduction_factor': 0.1,
+            'shuffle_buffer': 10000,
+            'augment': None,
+            'chunk_size': None
         }
 
         if self.args.debug_mode:
             self.training_params['step'] = 1
             self.training_params['stop'] = 1
 
+        if self.args.online_augmentation:
+            self.training_params['augment'] = ONLINE_AUGMENTATION
+        if self.args.out_of_core:
+            self.training_params['chunk_size'] = OUT_OF_CORE_CHUNK_SIZE
+
         self.prediction_params = {
             'batch_size': 64
         }
@@ -56,21 +71,23 @@ class VanillaCNN:
     def save_best_full_model(self):
         logger.info(f"Saving best full model")
         loc = self.model_directory + "/vanilla_cnn_full_model.h5"
-        self.full_model.save(loc)
+        self.checkpoint_writer.save(self.full_model, loc)
         return loc
 
     def save_full_model(self):
         logger.info(f"Saving full model")
         loc = self.model_directory + "/vanilla_cnn_full_model_tmp.h5"
-        self.full_model.save(loc)
+        self.checkpoint_writer.save(self.full_model, loc)
         return loc
 
     def load_full_model(self, location):
         logger.info(f"Loading full model")
+        self.checkpoint_writer.flush()
         self.full_model = tf.keras.models.load_model(location)
 
     def load_best_full_model(self):
         logger.info(f"Loading best full model")
+        self.checkpoint_writer.flush()
         self.full_model = tf.keras.models.load_model(self.model_directory + "/vanilla_cnn_full_model.h5")
 
     def train(self, training_data, validation_data):
@@ -88,26 +105,52 @@ class VanillaCNN:
         self.full_model = self.build_model(verbose=False)
         optim = tf.keras.optimizers.SGD(lr=p['lr'], nesterov=True, momentum=0.5)
         self.full_model.compile(optimizer=optim,
-                                loss='categorical_crossentropy',
+                                loss='sparse_categorical_crossentropy',
                                 metrics=['accuracy'])
-        loc = self.save_full_model()
-        tf.keras.backend.clear_session()
+        state = TrainingState([self.full_model], [self.save_best_full_model],
+                              [self.save_full_model], p['persist_every'], optim,
+                              self.model_directory + '/resume/full',
+                              self.checkpoint_writer.flush)
+
+        if self.args.pipeline:
+            val_ds = build_dataset(x_val, y_val, p['batch_size'],
+                                   transform=self.input_transform)
+            throughput = ThroughputLogger(
+                p['batch_size'],
+                memory_bound(x_train, p['batch_size'], p['shuffle_buffer'],
+                             p['chunk_size']))
 
         prev_val_loss = float('inf')
         counts_patience = 0
         patience = p["patience"]
+        if self.args.resume and state.resume():
+            if state.finished:
+                logger.info('Full classifier already trained')
+                return
+            index, prev_val_loss, counts_patience = (
+                state.epoch, state.best_loss, state.patience_count)
         while index < p['stop']:
-            tf.keras.backend.clear_session()
-            self.load_full_model(loc)
-            x_train, y_train, _ = shuffle_data((x_train, y_train))
-            full_fit = self.full_model.fit(x_train, y_train,
-                                           batch_size=p['batch_size'],
-                                           initial_epoch=index,
-                                           epochs=index + p["step"],
-                                           validation_data=(x_val, y_val),
-                                           callbacks=[self.tbCallback_full])
+            if self.args.pipeline:
+                train_ds = build_dataset(x_train, y_train, p['batch_size'],
+                                         shuffle=True, seed=index,
+                                         buffer_size=p['shuffle_buffer'],
+                                         augment=p['augment'],
+                                         chunk_size=p['chunk_size'],
+                                         transform=self.input_transform)
+                full_fit = self.full_model.fit(train_ds,
+                                               initial_epoch=index,
+                                               epochs=index + p["step"],
+                                               validation_data=val_ds,
+                                               callbacks=[self.tbCallback_full, throughput])
+            else:
+                train_seq = IndexSampler(x_train, y_train, p['batch_size'],
+                                         seed=index)
+                full_fit = self.full_model.fit(train_seq,
+                                               initial_epoch=index,
+                                               epochs=index + p["step"],
+                                               validation_data=(x_val, y_val),
+                                               callbacks=[self.tbCallback_full])
             val_loss = full_fit.history["val_loss"][-1]
-            loc = self.save_full_model()
             if prev_val_loss - val_loss < val_thresh:
                 counts_patience += 1
                 logger.info(f"Counts to early stopping: {counts_patience}/{p['patience']}")
@@ -117,13 +160,14 @@ class VanillaCNN:
                     new_val = optim.learning_rate * p["lr_reduction_factor"]
                     logger.info(f"LR is now: {new_val.numpy()}")
                     optim.learning_rate.assign(new_val)
-                    self.load_best_full_model()
-                    self.save_full_model()
+                    state.restore_best()
             else:
                 counts_patience = 0
                 prev_val_loss = val_loss
-                self.save_best_full_model()
+                state.improved()
             index += p["step"]
+            state.end_epoch(index, prev_val_loss, counts_patience)
+        state.finish()
 
     def predict(self, testing_data, results_file, fine2coarse):
         x_test, y_test = testing_data
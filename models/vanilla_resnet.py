@@ -6,26 +6,31 @@ import numpy as np
 
 import models.plugins as plugins
 import utils
-from datasets.preprocess import shuffle_data
+from datasets.augment import ONLINE_AUGMENTATION
+from datasets.pipeline import OUT_OF_CORE_CHUNK_SIZE, build_dataset, memory_bound
+from datasets.sampler import IndexSampler
 
 logger = logging.getLogger('ResNetBaseline')
 
 
 class VanillaResNet(plugins.ModelSaverPlugin):
     def __init__(self, n_fine_categories, n_coarse_categories, input_shape,
-                 logs_directory, model_directory=None, args=None):
+                 logs_directory, model_directory=None, args=None,
+                 input_transform=None):
         """
         ResNet baseline model
 
         """
         self.model_directory = model_directory
         self.args = args
+        self.input_transform = input_transform
         self.n_fine_categories = n_fine_categories
         self.n_coarse_categories = n_coarse_categories
         self.input_shape = input_shape
         self.loss_fun = None
         self.adam_coarse = None
         self.adam_fine = None
+        self.checkpoint_writer = plugins.AsyncCheckpointWriter()
 
         logger.debug(f"Creating full classifier with shared layers")
         self.full_classifier = self.build_full_classifier()
@@ -42,14 +47,23 @@ class VanillaResNet(plugins.ModelSaverPlugin):
             'batch_size': 64,
             'initial_epoch': 0,
             'step': 1,  # Save weights every this amount of epochs
+            'persist_every': 5,  # Write the weights to disk every this amount of epochs
             'stop': 1000,
             'lr': 1e-3,
             'val_thresh': 0,
             'patience': 10,
             'reduce_lr_after_patience_counts': 3,
-            'lr_reduction_factor': 0.25
+            'lr_reduction_factor': 0.25,
+            'shuffle_buffer': 10000,
+            'augment': None,
+            'chunk_size': None
         }
 
+        if self.args.online_augmentation:
+            self.training_params['augment'] = ONLINE_AUGMENTATION
+        if self.args.out_of_core:
+            self.training_params['chunk_size'] = OUT_OF_CORE_CHUNK_SIZE
+
         self.prediction_params = {
             'batch_size': 64
         }
@@ -66,44 +80,79 @@ class VanillaResNet(plugins.ModelSaverPlugin):
         prev_val_loss = float('inf')
         counts_patience = 0
 
-        self.save_model(self.model_directory + "/vanilla_tmp.h5", self.full_classifier)
+        # Compiled once, the weights stay in memory between epochs
+        self.full_classifier.compile(optimizer=optim,
+                                     loss='sparse_categorical_crossentropy',
+                                     metrics=['accuracy'])
+        state = plugins.TrainingState(
+            [self.full_classifier],
+            [lambda: self.save_model(self.model_directory + "/vanilla.h5",
+                                     self.full_classifier)],
+            [lambda: self.save_model(self.model_directory + "/vanilla_tmp.h5",
+                                     self.full_classifier)],
+            p['persist_every'], optim,
+            self.model_directory + '/resume/full',
+            self.checkpoint_writer.flush)
+
+        if self.args.pipeline:
+            x_train, y_train = training_data
+            val_ds = build_dataset(x_val, y_val, p['batch_size'],
+                                   transform=self.input_transform)
+            throughput = plugins.ThroughputLogger(
+                p['batch_size'],
+                memory_bound(x_train, p['batch_size'], p['shuffle_buffer'],
+                             p['chunk_size']))
+
+        if self.args.resume and state.resume():
+            if state.finished:
+                logger.info('Full classifier already trained')
+                return
+            index, prev_val_loss, counts_patience = (
+                state.epoch, state.best_loss, state.patience_count)
 
         while index < p['stop']:
-            tf.keras.backend.clear_session()
-            self.full_classifier = self.load_model(self.model_directory + "/vanilla_tmp.h5")
-
-            self.full_classifier.compile(optimizer=optim,
-                                         loss='categorical_crossentropy',
-                                         metrics=['accuracy'])
-
             # logger.info('Training coarse stage')
-            x_train, y_train, _ = shuffle_data(training_data)
-            fc = self.full_classifier.fit(x_train, y_train,
-                                          batch_size=p['batch_size'],
-                                          initial_epoch=index,
-                                          epochs=index + p['step'],
-                                          validation_data=(x_val, y_val),
-                                          callbacks=[self.tbCallback])
+            if self.args.pipeline:
+                train_ds = build_dataset(x_train, y_train, p['batch_size'],
+                                         shuffle=True, seed=index,
+                                         buffer_size=p['shuffle_buffer'],
+                                         augment=p['augment'],
+                                         chunk_size=p['chunk_size'],
+                                         transform=self.input_transform)
+                fc = self.full_classifier.fit(train_ds,
+                                              initial_epoch=index,
+                                              epochs=index + p['step'],
+                                              validation_data=val_ds,
+                                              callbacks=[self.tbCallback, throughput])
+            else:
+                x_train, y_train = training_data
+                train_seq = IndexSampler(x_train, y_train, p['batch_size'],
+                                         seed=index)
+                fc = self.full_classifier.fit(train_seq,
+                                              initial_epoch=index,
+                                              epochs=index + p['step'],
+                                              validation_data=(x_val, y_val),
+                                              callbacks=[self.tbCallback])
             val_loss = fc.history['val_loss'][0]
 
-            self.save_model(self.model_directory + "/vanilla_tmp.h5", self.full_classifier)
-
             if prev_val_loss - val_loss < p['val_thresh']:
                 counts_patience += 1
                 logger.info(f"Counts to early stopping: {counts_patience}/{p['patience']}")
                 if counts_patience >= p['patience']:
                     break
                 elif counts_patience % p["reduce_lr_after_patience_counts"] == 0:
-                    self.full_classifier = self.load_model(self.model_directory + "/vanilla.h5")
+                    state.restore_best()
                     new_val = optim.learning_rate * p["lr_reduction_factor"]
                     logger.info(f"LR is now: {new_val.numpy()}")
                     optim.learning_rate.assign(new_val)
             else:
                 counts_patience = 0
                 prev_val_loss = val_loss
-                self.save_model(self.model_directory + "/vanilla.h5", self.full_classifier)
+                state.improved()
 
             index += p['step']
+            state.end_epoch(index, prev_val_loss, counts_patience)
+        state.finish()
 
     def predict_fine(self, testing_data, results_file, fine2coarse):
         x_test, y_test = testing_data
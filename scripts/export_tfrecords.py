@@ -0,0 +1,89 @@
+import argparse
+import logging
+
+import os
+
+import datasets
+from datasets.tfrecord import export_tfrecords
+from scripts.hat_resnet import get_data_directory, get_data
+
+
+def main(args):
+    logging.basicConfig(level=args.log_level,
+                        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    logger = logging.getLogger('')
+
+    data_directory = get_data_directory(args)
+    logger.debug(f'Data directory: {data_directory}')
+
+    output = args.output
+    if output == '':
+        output = os.path.join(data_directory, 'tfrecords')
+    logger.debug(f'Output directory: {output}')
+
+    if args.storage == 'uint8':
+        args.online_augmentation = True
+
+    logger.info('Getting data')
+    augmentation = 'online' if args.online_augmentation else 'static'
+    data = get_data(args.dataset, data_directory, augmentation, args.mmap,
+                    args.zca_components, args.storage)
+    fine2coarse = data[3]
+
+    transform = None
+    if args.storage == 'uint8':
+        transform = datasets.get_cifar100_whitening(
+            data_directory, augmentation, args.zca_components, args.storage)
+
+    splits = {'train': data[0], 'test': data[1], 'val': data[2]}
+    for name, (x, y) in splits.items():
+        logger.info(f'Exporting {name} split')
+        # With uint8 storage only the test set is whitened at load time, the
+        # train and validation shards keep raw images and their transform
+        whitening = transform if name != 'test' else None
+        export_tfrecords(output, name, x, y, fine2coarse.coarse(y),
+                         n_shards=args.shards, compression=args.compression,
+                         whitening=whitening)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Export the preprocessed dataset as sharded TFRecords'
+    )
+    parser.add_argument('-s', '--shards', help='Number of shards per split',
+                        type=int, default=16)
+    parser.add_argument('-c', '--compression', help='Compression of the shards',
+                        type=str, default='GZIP',
+                        choices=['GZIP', 'ZLIB', ''])
+    parser.add_argument('-o', '--output', help='Where to write the shards '
+                                               '(defaults to <data_dir>/tfrecords)',
+                        type=str, default='')
+    parser.add_argument('-aug', '--online_augmentation',
+                        help='Export the images without the static augmented copy',
+                        action='store_true')
+    parser.add_argument('-mmap', '--mmap',
+                        help='Memory-map the preprocessed data instead of loading it',
+                        action='store_true')
+    parser.add_argument('--zca_components', help='Keep only the top K principal components '
+                                                 'in the ZCA whitening (defaults to all)',
+                        type=int, default=None)
+    parser.add_argument('--storage', help='Dtype of the cached images (uint8 implies '
+                                          '--online_augmentation)',
+                        type=str, default='float32',
+                        choices=['float32', 'uint8'])
+    parser.add_argument('-d', '--dataset', help='Dataset to use',
+                        type=str, default='cifar100',
+                        choices=['cifar100'])
+    parser.add_argument('--data_dir', help='Where to store data on the local'
+                                           ' machine (defaults to ./data)',
+                        type=str, default='./data')
+    parser.add_argument('-l', '--log_level', help='Logs level',
+                        type=str, default='INFO',
+                        choices=['WARNING', 'INFO', 'DEBUG', 'ERROR'])
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    main(args)
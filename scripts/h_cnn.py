@@ -3,8 +3,9 @@ import logging
 
 import os
 
+import datasets
 import models
-from scripts.hat_resnet import get_logs_file, get_model_directory, get_data_directory, get_results_file, get_data
+from scripts.hat_resnet import get_logs_file, get_model_directory, get_data_directory, get_results_file, get_data, add_data_arguments, normalize_data_args
 
 
 def main(args):
@@ -32,18 +33,17 @@ def main(args):
     results_file = get_results_file(args)
     logger.debug(f'Results file: {results_file}')
 
+    normalize_data_args(args)
+
     logger.info('Getting data')
-    data = get_data(args.dataset, data_directory)
+    augmentation = 'online' if args.online_augmentation else 'static'
+    data = get_data(args.dataset, data_directory, augmentation, args.mmap,
+                    args.zca_components, args.storage, args.out_of_core, args.shared,
+                    args.subset)
     training_data = data[0]
     testing_data = data[1]
     validation_data = data[2]
 
-    if args.debug_mode:
-        logger.info('Removing data. Keeping only 100 samples')
-        training_data = training_data[0][:100], training_data[1][:100]
-        testing_data = testing_data[0][:100], testing_data[1][:100]
-        validation_data = validation_data[0][:100], validation_data[1][:100]
-
     fine2coarse = data[3]
     n_fine_categories = data[4]
     n_coarse_categories = data[5]
@@ -52,13 +52,19 @@ def main(args):
     best_cc = None
     best_fc = None
 
+    input_transform = None
+    if args.storage == 'uint8':
+        input_transform = datasets.get_cifar100_whitening(
+            data_directory, augmentation, args.zca_components, args.storage).whiten_batch
+
     logger.info('Building model')
     net = models.HCNN(n_fine_categories=n_fine_categories,
                       n_coarse_categories=n_coarse_categories,
                       input_shape=input_shape,
                       logs_directory=logs_directory,
                       model_directory=model_directory,
-                      args=args)
+                      args=args,
+                      input_transform=input_transform)
 
     if args.train_c:
         logger.info('Entering Coarse Classifier training')
@@ -95,6 +101,11 @@ def main(args):
         else:
             net.load_best_fc_model()
         net.predict_fine(testing_data, results_file)
+    if args.export_serving is not None:
+        logger.info('Exporting serving model')
+        whitening = datasets.get_cifar100_whitening(data_directory, augmentation,
+                                                    args.zca_components, args.storage)
+        net.export_serving_model(whitening, args.export_serving)
 
 
 def parse_arguments():
@@ -113,6 +124,9 @@ def parse_arguments():
                         action='store_true')
     parser.add_argument('-te_full', '--test_full', help='Test a full model',
                         action='store_true')
+    parser.add_argument('--export_serving', help='Export the best full model behind a fused '
+                                                 'ZCA whitening layer to this file',
+                        type=str, default=None)
     parser.add_argument('-m', '--model', help='Specify where to store model',
                         type=str, default='')
     parser.add_argument('-n', '--name', help='Model run name',
@@ -133,6 +147,8 @@ def parse_arguments():
     parser.add_argument('-r', '--results', help='Results file',
                         type=str, default='')
 
+    add_data_arguments(parser)
+
     return parser.parse_args()
 
 
@@ -6,7 +6,7 @@ import os
 
 import datasets
 import models
-from datasets.preprocess import train_test_split, shuffle_data
+from datasets.preprocess import split_views, stratified_split
 
 
 def get_model_directory(args):
@@ -41,14 +41,30 @@ def get_logs_file(model_name):
     return logs_file
 
 
-def get_data(dataset, data_directory):
+def get_data(dataset, data_directory, augmentation='static', mmap=False,
+             zca_components=None, storage='float32', out_of_core=False,
+             shared=False, subset=None):
     if dataset == 'cifar100':
-        logging.info('Getting CIFAR-100 dataset')
-        tr, te, fine2coarse, n_fine, n_coarse = datasets.get_cifar100(
-            data_directory)
-        tr_x, tr_y, _ = shuffle_data(tr, random_state=0)
-        tr = tr_x, tr_y
-        tr, val = train_test_split(tr)
+        data = None
+        if shared and subset is None:
+            logging.info('Attaching to the hosted CIFAR-100 dataset')
+            data = datasets.attach_cifar100(data_directory, augmentation,
+                                            zca_components, storage)
+            if data is None:
+                logging.warning('No hosted CIFAR-100 dataset, loading it')
+        if data is None:
+            logging.info('Getting CIFAR-100 dataset')
+            data = datasets.get_cifar100(
+                data_directory, augmentation, mmap, zca_components, storage,
+                subset)
+        tr, te, fine2coarse, n_fine, n_coarse = data
+        if subset is not None:
+            inds_train, inds_val = stratified_split(tr[1])
+        else:
+            inds_train, inds_val = datasets.get_cifar100_split(
+                data_directory, tr[1], augmentation, zca_components, storage)
+        tr, val = split_views(tr, inds_train, inds_val,
+                              read_val=not out_of_core)
         logging.debug(
             f'Training set: x_dims={tr[0].shape}, y_dims={tr[1].shape}')
         logging.debug(
@@ -56,6 +72,61 @@ def get_data(dataset, data_directory):
     return tr, te, val, fine2coarse, n_fine, n_coarse
 
 
+def add_data_arguments(parser):
+    """Adds the options of the input pipeline, data loading and
+    preprocessing shared by the training scripts, and --resume.
+    """
+    parser.add_argument('--resume', help='Resume the interrupted training stages from '
+                                          'their last checkpoint, skipping the finished ones',
+                        action='store_true')
+    parser.add_argument('-pipe', '--pipeline', help='Feed training through a tf.data pipeline',
+                        action='store_true')
+    parser.add_argument('-aug', '--online_augmentation',
+                        help='Augment the training images online on every epoch '
+                             'instead of storing an augmented copy (implies --pipeline)',
+                        action='store_true')
+    parser.add_argument('-mmap', '--mmap',
+                        help='Memory-map the preprocessed data instead of loading it '
+                             '(implies --pipeline)',
+                        action='store_true')
+    parser.add_argument('-ooc', '--out_of_core',
+                        help='Train from chunked reads of the memory-mapped data through a '
+                             'bounded shuffle buffer, logging throughput and the memory '
+                             'bound of the input pipeline (implies --mmap)',
+                        action='store_true')
+    parser.add_argument('--shared', help='Attach read-only to the dataset hosted in shared '
+                                         'memory by scripts/host_dataset.py instead of '
+                                         'loading a private copy',
+                        action='store_true')
+    parser.add_argument('--subset', help='Only load, preprocess and use this many samples per '
+                                         'class, without caching them (defaults to 10 in '
+                                         'debug mode)',
+                        type=int, default=None)
+    parser.add_argument('--zca_components', help='Keep only the top K principal components '
+                                                 'in the ZCA whitening (defaults to all)',
+                        type=int, default=None)
+    parser.add_argument('--storage', help='Dtype of the cached images. uint8 keeps the raw '
+                                          'images and whitens them per batch (implies '
+                                          '--online_augmentation)',
+                        type=str, default='float32',
+                        choices=['float32', 'uint8'])
+
+
+def normalize_data_args(args):
+    """Applies the implications between the options of add_data_arguments."""
+    if getattr(args, 'debug_mode', False) and args.subset is None:
+        args.subset = 10
+    if args.subset is not None:
+        # Subsets are preprocessed in memory, there is no cache to whiten from
+        args.storage = 'float32'
+    if args.storage == 'uint8':
+        args.online_augmentation = True
+    if args.out_of_core:
+        args.mmap = True
+    if args.online_augmentation or args.mmap:
+        args.pipeline = True
+
+
 def main(args):
     logs_file = get_logs_file(args.name)
     logs_directory = os.path.dirname(logs_file)
@@ -81,18 +152,17 @@ def main(args):
     results_file = get_results_file(args)
     logger.debug(f'Results file: {results_file}')
 
+    normalize_data_args(args)
+
     logger.info('Getting data')
-    data = get_data(args.dataset, data_directory)
+    augmentation = 'online' if args.online_augmentation else 'static'
+    data = get_data(args.dataset, data_directory, augmentation, args.mmap,
+                    args.zca_components, args.storage, args.out_of_core, args.shared,
+                    args.subset)
     training_data = data[0]
     testing_data = data[1]
     validation_data = data[2]
 
-    if args.debug_mode:
-        logger.info('Removing data. Keeping only 100 samples')
-        training_data = training_data[0][:100], training_data[1][:100]
-        testing_data = testing_data[0][:100], testing_data[1][:100]
-        validation_data = validation_data[0][:100], validation_data[1][:100]
-
     fine2coarse = data[3]
     n_fine_categories = data[4]
     n_coarse_categories = data[5]
@@ -101,13 +171,19 @@ def main(args):
     best_cc = None
     best_fc = None
 
+    input_transform = None
+    if args.storage == 'uint8':
+        input_transform = datasets.get_cifar100_whitening(
+            data_directory, augmentation, args.zca_components, args.storage).whiten_batch
+
     logger.info('Building model')
     net = models.HATResNet(n_fine_categories=n_fine_categories,
                            n_coarse_categories=n_coarse_categories,
                            input_shape=input_shape,
                            logs_directory=logs_directory,
                            model_directory=model_directory,
-                           args=args)
+                           args=args,
+                           input_transform=input_transform)
 
     if args.train_c:
         logger.info('Entering Coarse Classifier training')
@@ -144,6 +220,11 @@ def main(args):
         else:
             net.load_best_fc_model()
         net.predict_fine(testing_data, results_file)
+    if args.export_serving is not None:
+        logger.info('Exporting serving model')
+        whitening = datasets.get_cifar100_whitening(data_directory, augmentation,
+                                                    args.zca_components, args.storage)
+        net.export_serving_model(whitening, args.export_serving)
 
 
 def parse_arguments():
@@ -162,6 +243,9 @@ def parse_arguments():
                         action='store_true')
     parser.add_argument('-te_full', '--test_full', help='Test a full model',
                         action='store_true')
+    parser.add_argument('--export_serving', help='Export the best full model behind a fused '
+                                                 'ZCA whitening layer to this file',
+                        type=str, default=None)
     parser.add_argument('-m', '--model', help='Specify where to store model',
                         type=str, default='')
     parser.add_argument('-n', '--name', help='Model run name',
@@ -182,6 +266,8 @@ def parse_arguments():
     parser.add_argument('-r', '--results', help='Results file',
                         type=str, default='')
 
+    add_data_arguments(parser)
+
     return parser.parse_args()
 
 
@@ -6,7 +6,7 @@ import os
 
 import datasets
 import models
-from datasets.preprocess import train_test_split, shuffle_data
+from datasets.preprocess import one_hot, train_test_split, shuffle_data
 
 
 def get_model_directory():
@@ -51,6 +51,9 @@ def get_data(dataset, data_directory):
         logging.info('Getting CIFAR-100 dataset')
         tr, te, fine2coarse, n_fine, n_coarse = datasets.get_cifar100(
             data_directory)
+        # HDCNN trains on one-hot labels
+        tr = tr[0], one_hot(tr[1], n_fine)
+        te = te[0], one_hot(te[1], n_fine)
         logging.debug(
             f'Training set: x_dims={tr[0].shape}, y_dims={tr[1].shape}')
         logging.debug(
@@ -125,6 +128,9 @@ def parse_arguments():
 
     parser.add_argument('-tr', '--train', help='Train a new model',
                         action='store_true')
+    parser.add_argument('--resume', help='Resume the interrupted training stages from '
+                                          'their last checkpoint, skipping the finished ones',
+                        action='store_true')
     parser.add_argument('-te', '--test', help='Test a model',
                         action='store_true')
     parser.add_argument('-m', '--model', help='Specify where to store model',
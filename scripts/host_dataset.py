@@ -0,0 +1,63 @@
+import argparse
+import logging
+import signal
+
+import datasets
+from scripts.hat_resnet import get_data_directory
+
+
+def main(args):
+    logging.basicConfig(level=args.log_level,
+                        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    logger = logging.getLogger('')
+
+    data_directory = get_data_directory(args)
+    logger.debug(f'Data directory: {data_directory}')
+
+    augmentation = 'online' if args.online_augmentation else 'static'
+    shared = datasets.host_cifar100(data_directory, augmentation,
+                                    args.zca_components, args.storage)
+
+    # Exit cleanly on SIGTERM as well as on Ctrl-C, so the segment is removed
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    logger.info('Dataset hosted, run the training scripts with --shared. '
+                'Press Ctrl-C to stop hosting')
+    try:
+        signal.pause()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logger.info('Removing the shared dataset')
+        shared.close()
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Host the preprocessed dataset in shared memory for the '
+                    'training scripts run with --shared'
+    )
+    parser.add_argument('-aug', '--online_augmentation',
+                        help='Host the images without the static augmented copy',
+                        action='store_true')
+    parser.add_argument('--zca_components', help='Keep only the top K principal components '
+                                                 'in the ZCA whitening (defaults to all)',
+                        type=int, default=None)
+    parser.add_argument('--storage', help='Dtype of the cached images',
+                        type=str, default='float32',
+                        choices=['float32', 'uint8'])
+    parser.add_argument('-d', '--dataset', help='Dataset to use',
+                        type=str, default='cifar100',
+                        choices=['cifar100'])
+    parser.add_argument('--data_dir', help='Where to store data on the local'
+                                           ' machine (defaults to ./data)',
+                        type=str, default='./data')
+    parser.add_argument('-l', '--log_level', help='Logs level',
+                        type=str, default='INFO',
+                        choices=['WARNING', 'INFO', 'DEBUG', 'ERROR'])
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    main(args)
@@ -0,0 +1,58 @@
+import argparse
+import logging
+
+import datasets
+from scripts.hat_resnet import get_data_directory
+
+
+def main(args):
+    logging.basicConfig(level=args.log_level,
+                        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    logger = logging.getLogger('')
+
+    data_directory = get_data_directory(args)
+    logger.debug(f'Data directory: {data_directory}')
+
+    augmentation = 'online' if args.online_augmentation else 'static'
+    cache_dir = datasets.preprocess_cifar100(data_directory, augmentation,
+                                             args.zca_components, args.storage,
+                                             args.workers, args.chunk_size)
+    logger.info(f'Preprocessed data in {cache_dir}')
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Preprocess the dataset cache with a pool of worker processes. '
+                    'Rerun to resume an interrupted run'
+    )
+    parser.add_argument('-w', '--workers', help='Number of worker processes '
+                                                '(defaults to the number of CPUs)',
+                        type=int, default=None)
+    parser.add_argument('--chunk_size', help='Number of images per task '
+                                             '(rounded up to a multiple of 1024)',
+                        type=int, default=5120)
+    parser.add_argument('-aug', '--online_augmentation',
+                        help='Preprocess the images without the static augmented copy',
+                        action='store_true')
+    parser.add_argument('--zca_components', help='Keep only the top K principal components '
+                                                 'in the ZCA whitening (defaults to all)',
+                        type=int, default=None)
+    parser.add_argument('--storage', help='Dtype of the cached images',
+                        type=str, default='float32',
+                        choices=['float32', 'uint8'])
+    parser.add_argument('-d', '--dataset', help='Dataset to use',
+                        type=str, default='cifar100',
+                        choices=['cifar100'])
+    parser.add_argument('--data_dir', help='Where to store data on the local'
+                                           ' machine (defaults to ./data)',
+                        type=str, default='./data')
+    parser.add_argument('-l', '--log_level', help='Logs level',
+                        type=str, default='INFO',
+                        choices=['WARNING', 'INFO', 'DEBUG', 'ERROR'])
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    main(args)
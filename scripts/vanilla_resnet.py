@@ -3,9 +3,10 @@ import logging
 
 import os
 
+import datasets
 import models
-from datasets.preprocess import train_test_split, shuffle_data
-from scripts.hat_resnet import get_logs_file, get_model_directory, get_data_directory, get_results_file, get_data
+from datasets.preprocess import train_test_split
+from scripts.hat_resnet import get_logs_file, get_model_directory, get_data_directory, get_results_file, get_data, add_data_arguments, normalize_data_args
 
 
 def main(args):
@@ -33,8 +34,13 @@ def main(args):
     results_file = get_results_file(args)
     logger.debug(f'Results file: {results_file}')
 
+    normalize_data_args(args)
+
     logger.info('Getting data')
-    data = get_data(args.dataset, data_directory)
+    augmentation = 'online' if args.online_augmentation else 'static'
+    data = get_data(args.dataset, data_directory, augmentation, args.mmap,
+                    args.zca_components, args.storage, args.out_of_core, args.shared,
+                    args.subset)
     training_data = data[0]
     testing_data = data[1]
     validation_data = data[2]
@@ -43,18 +49,22 @@ def main(args):
     n_coarse_categories = data[5]
     input_shape = training_data[0][0].shape
 
+    input_transform = None
+    if args.storage == 'uint8':
+        input_transform = datasets.get_cifar100_whitening(
+            data_directory, augmentation, args.zca_components, args.storage).whiten_batch
+
     logger.info('Building model')
     net = models.VanillaResNet(n_fine_categories=n_fine_categories,
                                n_coarse_categories=n_coarse_categories,
                                input_shape=input_shape,
                                logs_directory=logs_directory,
                                model_directory=model_directory,
-                               args=args)
+                               args=args,
+                               input_transform=input_transform)
 
     if args.train:
         logger.info('Entering training')
-        trdx, trdy, _ = shuffle_data(training_data)
-        training_data = trdx, trdy
         net.train(training_data, validation_data)
     if args.test:
         logger.info('Entering testing')
@@ -88,6 +98,8 @@ def parse_arguments():
     parser.add_argument('-r', '--results', help='Results file',
                         type=str, default='')
 
+    add_data_arguments(parser)
+
     return parser.parse_args()
 
 
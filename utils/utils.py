@@ -7,6 +7,10 @@ logger = logging.getLogger("utils")
 
 
 def get_error(y, yh):
+    y = np.asarray(y)
+    if y.ndim == 1:
+        # Integer labels
+        return np.count_nonzero(y != np.argmax(yh, 1)) / len(y)
     # Threshold
     yht = np.zeros(np.shape(yh))
     yht[np.arange(len(yh)), yh.argmax(1)] = 1